@@ -44,12 +44,13 @@ Version History
 import os, sys
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../..')))
 
-from lib.bootstrap import ferret
+from lib.bootstrap import ferret, result_cache
 
 
 def main():
 
     rng_seed = 49252466450692985656297363781
+    cache = result_cache('Results/Localization/data/bootstrap/.cache')            # Reuse results if data and parameters are unchanged
        
     ferrets = [ferret(1311, 'Magnum', rng_seed), ferret(1509, 'Robin', rng_seed)]   
     
@@ -63,15 +64,17 @@ def main():
         f.data = f.data[f.data['Condition'].isin(['Control','Bilateral'])] 
 
         # # Run bootstrap across speaker location for bilateral cooling
-        # f.bootstrap(plot_vars=['Condition'], flat_vars=['SpkrPos','Atten'], nBoots=1000)
+        # f.bootstrap(plot_vars=['Condition'], flat_vars=['SpkrPos','Atten'], nBoots=1000, cache=cache)
         # f.write_results('Results/Localization/data/bootstrap', 'Control_vs_bilateral')
         
         # Run bootstrap by speaker hemifield
         f.data = f.unilateral_data
 
-        f.bootstrap(plot_vars=['Condition','spkr_hemifield'], flat_vars=['SpkrPos','Atten'], nBoots=1000)
+        f.bootstrap(plot_vars=['Condition','spkr_hemifield'], flat_vars=['SpkrPos','Atten'], nBoots=1000, cache=cache)
         f.write_results('Results/Localization/data/bootstrap', 'Left_vs_Right')
-        
+
+    print(f"Bootstrap cache: {cache.stats()}")
+
      
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -16,10 +16,11 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from typing import Optional
 import seaborn as sns
 
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../../..')))
-from Results import cooling_analysis as ca
+from Results.session_files import read_session_files
 
 
 class Cooling(Enum):
@@ -31,39 +32,21 @@ class Cooling(Enum):
     BILATERAL = 'Bilateral'
     
 
-def import_original_behavior(file_path: Path) -> pd.DataFrame:
+def import_original_behavior(file_path: Path, cache_dir: Optional[str] = None) -> pd.DataFrame:
     """ Gather behavioral data from directories split by condition"""
 
-    all_data = []
+    # List results files for each type of cooling
+    text_files = [(condition, text_file) for condition in Cooling for text_file in (file_path / condition.value).glob('*.txt')]
 
-    # For each type of cooling
-    for condition in Cooling:    
+    # Read files in parallel (with unnamed columns removed, due to formatting of source data)
+    all_data = read_session_files([x[1] for x in text_files], cache_dir=cache_dir, session_date='SessionDate')
 
-        # Extend path
-        condition_dir = file_path / condition.value
+    # Add session metadata
+    for (condition, text_file), behav in zip(text_files, all_data):
+        behav['Condition'] = condition.value
+        behav['originalFile'] = text_file.stem
 
-        # For each results file
-        for text_file in condition_dir.glob('*.txt'):
-
-            behav = pd.read_csv( text_file, sep='\t', encoding='latin1')
-            
-            # Add session metadata
-            behav['Condition'] = condition.value    
-            behav['SessionDate'] = ca.filename_to_sessiondate(text_file.name)
-            behav['originalFile'] = text_file.stem
-
-            # Add data to list of all data
-            all_data.append(behav)
-
-    all_data = pd.concat(all_data)
-
-
-
-    # Remove unnamed columns (due to formatting of source data)    
-    unnamed = [x for x in all_data.columns if 'Unnamed' in x]
-    all_data.drop(columns=unnamed, inplace=True)
-
-    return all_data
+    return pd.concat(all_data)
 
 
 def replace_error_values(df: pd.DataFrame, column : str) -> None:
@@ -110,7 +93,7 @@ def main():
     # For each file for which temperature data is available
     paths['behavior'] = paths['data'] / 'original/F1311_Magnum'
     
-    behavior = import_original_behavior(paths['behavior'])
+    behavior = import_original_behavior(paths['behavior'], cache_dir=paths['data'] / '.cache/session_files')
 
     # Expand behavior so that the data is in the shape we eventually want
     behavior.reset_index(drop=True, inplace=True)
@@ -198,7 +198,7 @@ def main():
 
         pt = ca.permutation_test( 
             nTrials['Control'], nTrials['Bilateral'], 
-            nCorrect['Control'], nCorrect['Bilateral'], nIterations=10000)
+            nCorrect['Control'], nCorrect['Bilateral'], method='exact')
 
         print(f"{fNum}, bilateral vs control:  p = {pt['p_below']}")
 
@@ -33,7 +33,9 @@ from scipy.stats import sem
 
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../..')))
 from lib import plot_utils as cplot
+from lib.bootstrap import read_table
 from Results.Localization.plotting import metric_axes
+from Results.cooling_analysis import continuous_permutation_test
 
 
 colors = dict(
@@ -58,8 +60,8 @@ class ferret_to_plot():
     def load_bootstrap_results(self, file_path : str) -> None:
         """ Load results from bootstrapping """
         file_path = Path(file_path)
-        self.bilateral_bootstrap = pd.read_csv( file_path / f"F{self.num}_Control_vs_bilateral.csv")
-        self.unilateral_bootstrap = pd.read_csv( file_path / f"F{self.num}_Left_vs_Right.csv")
+        self.bilateral_bootstrap = read_table( file_path / f"F{self.num}_Control_vs_bilateral")     # Any format written by ferret.write_results
+        self.unilateral_bootstrap = read_table( file_path / f"F{self.num}_Left_vs_Right")
 
 
     def load_analysis_data(self, file_path : str) -> None:
@@ -91,6 +93,23 @@ class ferret_to_plot():
             print(f"{condition}: Mean error = {xf['Error'].mean()}°)")
 
 
+    def report_error_permutation_tests(self, column: str = 'Error', nIterations: int = 100000) -> None:
+        ''' Text report of permutation tests on response error (or any numeric column) for bilateral vs. control, and right vs. left cooling in each speaker hemifield '''
+
+        df = self.analysis_data
+        contrasts = dict(
+            bilateral = (df['Condition'] == 'Control', df['Condition'] == 'Bilateral', 'Bilateral - Control'),
+            left_hemifield = ((df['Condition'] == 'Left') & (df['spkr_hemifield'] == 'L'), (df['Condition'] == 'Right') & (df['spkr_hemifield'] == 'L'), 'SL: CRight - CLeft'),
+            right_hemifield = ((df['Condition'] == 'Left') & (df['spkr_hemifield'] == 'R'), (df['Condition'] == 'Right') & (df['spkr_hemifield'] == 'R'), 'SR: CRight - CLeft')
+        )
+
+        for is_control, is_test, label in contrasts.values():
+            for statistic in ('mean', 'median'):
+                
+                pt = continuous_permutation_test(df.loc[is_control, column], df.loc[is_test, column], statistic=statistic, nIterations=nIterations)
+                print(f"F{self.num}, {label}: {statistic} {column} delta = {pt['observed_delta']:.2f}, p_below = {pt['p_below']}, p_above = {pt['p_above']}")
+
+
 @dataclass()
 class localization_figure():
     """ Output figure  """
@@ -401,6 +420,7 @@ def main():
         # Get summary statistics
         # f.get_effect_of_cooling()
         f.report_performance_by_cooling_condition()
+        f.report_error_permutation_tests()
 
         # Plot data
         add_confusion_matrices(sfig, f)    
@@ -44,12 +44,13 @@ Version History
 import os, sys
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../..')))
 
-from lib.bootstrap import ferret
+from lib.bootstrap import ferret, result_cache
 
 
 def main():
 
     rng_seed = 49252466450692985656297363781
+    cache = result_cache('Results/Vowels_in_Noise/data/bootstrap/.cache')          # Reuse results if data and parameters are unchanged
        
     ferrets = [ferret(1311, 'Magnum', rng_seed), ferret(1509, 'Robin', rng_seed), ferret(1706, 'Mimi', rng_seed)]   
     
@@ -57,14 +58,15 @@ def main():
         
         f.load_data('Results/Vowels_in_Noise/data/analysis')
 
-        # Run bootstrap by SNR
-        f.bootstrap(plot_vars=['Mask','treatment','SNR'], flat_vars=['vowel'], nBoots=1000)   # Flattening doesn't check ranges
-        f.write_results('Results/Vowels_in_Noise/data/bootstrap', 'BY_SNR')
-        
-        # Run bootstrap across SNR
-        f.bootstrap(plot_vars=['Mask','treatment'], flat_vars=['SNR','vowel'], nBoots=1000)
-        f.write_results('Results/Vowels_in_Noise/data/bootstrap', 'OVER_SNR')
-        
+        # Run bootstrap by SNR and across SNR (from the same resamples)
+        f.bootstrap(specs=dict(
+            BY_SNR=(['Mask','treatment','SNR'], ['vowel']),             # Flattening doesn't check ranges
+            OVER_SNR=(['Mask','treatment'], ['SNR','vowel'])
+            ), nBoots=1000, cache=cache)
+        f.write_results('Results/Vowels_in_Noise/data/bootstrap')
+
+    print(f"Bootstrap cache: {cache.stats()}")
+
      
 if __name__ == '__main__':
     main()
\ No newline at end of file
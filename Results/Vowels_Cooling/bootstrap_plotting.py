@@ -31,7 +31,7 @@ from pathlib import Path
 
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../..')))
 
-from lib.bootstrap import ferret
+from lib.bootstrap import ferret, read_table
 from lib.colors import VOWELS_IN_NOISE as colors
 from lib.colors import f_markers
 from lib.settings import noise_level
@@ -53,8 +53,8 @@ class ferret_to_plot():
     def load_bootstrap_results(self, file_path : str) -> None:
         """ Load results from bootstrapping """
         file_path = Path(file_path)
-        self.bootstrap_BY_SNR = pd.read_csv( file_path / f"F{self.num}_BY_SNR.csv")
-        self.bootstrap_over_SNR = pd.read_csv( file_path / f"F{self.num}_OVER_SNR.csv")
+        self.bootstrap_BY_SNR = read_table( file_path / f"F{self.num}_BY_SNR")              # Any format written by ferret.write_results
+        self.bootstrap_over_SNR = read_table( file_path / f"F{self.num}_OVER_SNR")
 
 
     def get_effect_of_cooling(self) -> None:
@@ -8,40 +8,30 @@ Tested in white elephant with sounds in restricted noise only, varying vowel in
 
 '''
 
-from datetime import datetime
+import os, sys
 
 import pandas as pd
 from pathlib import Path
 
-parent_dir = Path('Results/Vowels_Cooling/data/original/F1706_Mimi')
+sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../../../../..')))
+from Results.cooling_analysis import filename_to_sessiondate
+from Results.session_files import read_session_files
 
+parent_dir = Path('Results/Vowels_Cooling/data/original/F1706_Mimi')
 
-def filename_to_sessiondate(s):
 
-    [f_date, _, f_time, _] = s.split()
-    date_string = f_date + ' ' + f_time[0:5]
-    session_dt = datetime.strptime(date_string, '%d_%m_%Y %H_%M')
+def main():
 
-    return session_dt
+    files = list(parent_dir.glob('*.txt'))
 
+    # Read files in parallel (with unnamed columns removed and column names corrected)
+    all_data = read_session_files(files, cache_dir='Results/Vowels_Cooling/data/.cache/session_files', index_col='Trial')
 
-def main():
-
-    all_data = []
-    for file in parent_dir.glob('*.txt'):
-        
-        df = pd.read_csv( str(file), delimiter='\t', encoding='latin1', index_col='Trial')
-        
-        unnamed = [x for x in df.columns if 'Unnamed' in x]
-        df.drop(unnamed, inplace=True, axis=1)
+    for file, df in zip(files, all_data):
 
         df['Mask'] = 1
         df['sessionDate'] = filename_to_sessiondate(file.stem)
 
-        df = df.rename(columns={'CorrectionTrial?': 'CorrectionTrial','CenterReward?': 'CenterReward'})
-
-        all_data.append(df)
-
     all_data = pd.concat(all_data)
     all_data.to_csv('Results/Vowels_Cooling/data/summary/F1706_Behavior.csv')
 
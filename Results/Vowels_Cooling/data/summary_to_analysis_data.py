@@ -25,6 +25,7 @@ from pathlib import Path
 
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../../..')))
 from lib import settings
+from lib.pipeline import pipeline, register_step
 from Results import cooling_analysis as ca
 
 
@@ -49,123 +50,171 @@ class ferret():
         file_path = Path(file_path) / f"F{self.num}.csv"                          
         self.data.to_csv(file_path, index=False)
 
-    def add_subject_metadata(self) -> None:
-        """ Add ferret number and method to dataframe """
-        self.data['fNum'] = self.num
-        self.data['method'] = self.method
+    def preprocessing_steps(self) -> list:
+        """ Steps (and parameters) that format summary data for analysis """
 
-    def add_session_date(self) -> None:
-        """ Extract date from session names for each trial"""
-        if 'originalFile' in self.data.columns:
-            self.data['sessionDate'] = self.data['originalFile'].apply(ca.filename_to_sessiondate)      
-        
-    def remove_correction_trials(self) -> None:
-        """ Only take non-correction trials """
-        self.data = self.data[self.data['CorrectionTrial'] == 0]                
+        treatment_var = 'opto' if self.method == 'opto' else 'isCooled'
 
-    def remove_trials_without_response(self) -> None:
-        """ Only take trials with responses (no response is very very rare) """
-        self.data = self.data[self.data['Response'] >= 0]
+        steps = [
+            remove_correction_trials,
+            remove_trials_without_response,
+            remove_continuous_noise_and_format_mask,
+            (add_subject_metadata, dict(num=self.num, method=self.method)),
+            add_session_date,
+            (add_reaction_times, dict(decimal_places=4))
+        ]
 
-    def add_reaction_times(self, decimal_places: int) -> None:
-        """ Turn start and response time marks into floating reaction time"""
-        
-        self.data['rxnTime'] = self.data['RespTime'] - self.data['StartTime']                                
-        self.data['rxnTime'] = self.data['rxnTime'].round(decimal_places)
+        if self.name == 'Magnum':
+            steps.append( magnum_level_correction)
 
-    def remove_continuous_noise_and_format_mask(self) -> None:
-        """ Drop data from other projects and make codes for noise masks human-readable"""
-        self.data = self.data[self.data['Mask'] < 2]                        
-        self.data['Mask'].replace({0:'Clean', 1:'Restricted'}, inplace=True)
+        steps += [
+            format_vowel_labels,
+            (format_sound_levels, dict(default_level=settings.default_level, noise_level=settings.noise_level))
+        ]
 
-    def format_vowel_labels(self) -> None:
-        """ Make codes for vowel identity human-readable """
+        if self.method == 'opto':                                               # Identify inactivation trials using a method-dependent strategy
+            steps.append( format_opto_treatment)
+        elif self.method == 'cool':
+            steps.append( (ca.temperature_preprocessing, dict(warm_threshold=settings.warm_threshold, cooled_threshold=settings.cooled_threshold)))
+
+        return steps + [
+            (ca.match_for_atten, dict(time_interval=self.attn_matching_window, condition_interval=self.attn_matching_variable)),  # Ensure that we only use the same attenuations tested within a specific time window
+            (remove_quiet_vowels, dict(min_level=settings.min_level)),
+            (ca.drop_rare_attenuations, dict(min_trials=settings.min_trials)),
+            (tidy_up_column_names, dict(treatment_var=treatment_var)),
+            (check_SNRs_are_balanced, dict(columns=['Mask','treatment','SNR', 'vowel']))
+        ]
 
-        self.data['vowel'] = self.data['F1'] + self.data['F2'] + self.data['F3'] + self.data['F4'] # This line could probably be shortend
-        self.data['vowel'].replace({8627:'u',9725:'a', 9850:'e', 10436:'i'}, inplace=True)  
+    def preprocess(self, cache_dir: str) -> None:
+        """ Run preprocessing pipeline (reusing cached results of unchanged steps) and report the cost of each step """
 
-    def format_sound_levels(self) -> None:
-        """ Express vowel levels in absolute terms and relative to noise (SNR)"""
+        steps = pipeline(self.preprocessing_steps(), cache_dir=cache_dir)
+        self.data = steps.run(self.data)
 
-        self.data['vowel_level'] = settings.default_level - self.data['Atten']
-        self.data['SNR'] = self.data['vowel_level'] - settings.noise_level
+        print(steps.log.to_string(index=False))
 
-    def format_treatment(self):
-        """ Identify inactivation trials using a method-dependent strategy """
 
-        if self.method == 'opto':                                                  
-            self.data['opto'].replace({0:False, 1:True}, inplace=True)
-            self.treatment_var = 'opto'
+# Preprocessing steps (each returns a new dataframe, without changing its input)
+register_step(ca.temperature_preprocessing)
+register_step(ca.match_for_atten)
+register_step(ca.drop_rare_attenuations)
 
-        elif self.method == 'cool':
-            self.data = ca.temperature_preprocessing(self.data, settings.warm_threshold, settings.cooled_threshold)
-            self.treatment_var = 'isCooled'
 
-    def match_attenuations(self) -> None:
-        """ Ensure that we only use the same attenuations tested within a specific time window"""
-        self.data = ca.match_for_atten(self.data, time_interval=self.attn_matching_window, condition_interval=self.attn_matching_variable)
+@register_step
+def add_subject_metadata(df: pd.DataFrame, num: int, method: str) -> pd.DataFrame:
+    """ Add ferret number and method to dataframe """
+    return df.assign(fNum=num, method=method)
 
-    def tidy_up_column_names(self) -> None:
-        
-        self.data.rename({self.treatment_var:'treatment'}, axis=1, inplace=True)                    
+@register_step
+def add_session_date(df: pd.DataFrame) -> pd.DataFrame:
+    """ Extract date from session names for each trial"""
+    if 'originalFile' in df.columns:
+        return df.assign(sessionDate=df['originalFile'].apply(ca.filename_to_sessiondate))
+    return df
+    
+@register_step
+def remove_correction_trials(df: pd.DataFrame) -> pd.DataFrame:
+    """ Only take non-correction trials """
+    return df[df['CorrectionTrial'] == 0]                
+
+@register_step
+def remove_trials_without_response(df: pd.DataFrame) -> pd.DataFrame:
+    """ Only take trials with responses (no response is very very rare) """
+    return df[df['Response'] >= 0]
+
+@register_step
+def add_reaction_times(df: pd.DataFrame, decimal_places: int) -> pd.DataFrame:
+    """ Turn start and response time marks into floating reaction time"""
+    return df.assign(rxnTime=(df['RespTime'] - df['StartTime']).round(decimal_places))
+
+@register_step
+def remove_continuous_noise_and_format_mask(df: pd.DataFrame) -> pd.DataFrame:
+    """ Drop data from other projects and make codes for noise masks human-readable"""
+    df = df[df['Mask'] < 2]                        
+    return df.assign(Mask=df['Mask'].replace({0:'Clean', 1:'Restricted'}))
+
+@register_step
+def format_vowel_labels(df: pd.DataFrame) -> pd.DataFrame:
+    """ Make codes for vowel identity human-readable """
+
+    vowel = df['F1'] + df['F2'] + df['F3'] + df['F4']                         # This line could probably be shortend
+    return df.assign(vowel=vowel.replace({8627:'u',9725:'a', 9850:'e', 10436:'i'}))
+
+@register_step
+def format_sound_levels(df: pd.DataFrame, default_level: float, noise_level: float) -> pd.DataFrame:
+    """ Express vowel levels in absolute terms and relative to noise (SNR)"""
+
+    vowel_level = default_level - df['Atten']
+    return df.assign(vowel_level=vowel_level, SNR=vowel_level - noise_level)
+
+@register_step
+def format_opto_treatment(df: pd.DataFrame) -> pd.DataFrame:
+    """ Identify inactivation trials from laser status """
+    return df.assign(opto=df['opto'].replace({0:False, 1:True}))
+
+@register_step
+def remove_quiet_vowels(df: pd.DataFrame, min_level: float) -> pd.DataFrame:
+    """ Only take vowels presented at or above the minimum sound level """
+    return df[df['vowel_level'] >= min_level]
+
+@register_step
+def tidy_up_column_names(df: pd.DataFrame, treatment_var: str) -> pd.DataFrame:
+    
+    df = df.rename({treatment_var:'treatment'}, axis=1)
 
-        columns = ['F1','F2','F3','F4','Side','RespTime','StartTime','UniversalStartTime','originalFile','day','CorrectionTrial','noiseAtten','laserOnset','laserOffset']  # Drop these columns
-        [self.data.drop(c, axis=1, inplace=True) for c in columns if c in self.data.columns.to_list() ]
+    columns = ['F1','F2','F3','F4','Side','RespTime','StartTime','UniversalStartTime','originalFile','day','CorrectionTrial','noiseAtten','laserOnset','laserOffset']  # Drop these columns
+    return df.drop([c for c in columns if c in df.columns.to_list()], axis=1)
 
-    def check_SNRs_are_balanced(self) -> None:
+@register_step
+def check_SNRs_are_balanced(df: pd.DataFrame, columns: list) -> pd.DataFrame:
 
-        columns = ['Mask','treatment','SNR', 'vowel']
-        isOk, n_trials = self.check_all_permutations_tested(self.data, columns)
+    isOk, n_trials = check_all_permutations_tested(df, columns)
 
-        if not isOk:
-            print('Permutation warning')
-            self.data = self.fix_unbalanced_stimuli(self.data, columns)
-    
+    if not isOk:
+        print('Permutation warning')
+        df = fix_unbalanced_stimuli(df, columns)
 
-    @staticmethod                                                                   # Brought directly from bootstrap
-    def check_all_permutations_tested(df: pd.DataFrame, columns: list) -> bool:
-        # Does data exist for all possible combinations of values within columns
+    return df
 
-        n_conditions = [len(df[c].unique()) for c in columns]
-        n_permutations = np.prod(n_conditions)
 
-        n_trials = df.groupby(by=columns).size()
-        
-        return n_trials.shape[0] == n_permutations, n_trials
+def check_all_permutations_tested(df: pd.DataFrame, columns: list) -> bool:     # Brought directly from bootstrap
+    # Does data exist for all possible combinations of values within columns
 
-    @staticmethod
-    def fix_unbalanced_stimuli(df: pd.DataFrame, columns: list):                # Brought directly from bootstrap
+    n_conditions = [len(df[c].unique()) for c in columns]
+    n_permutations = np.prod(n_conditions)
 
-        # Create a dataframe with all the required experimental conditions
-        conditions = [df[c].unique() for c in columns]
-        required = pd.DataFrame( list(itertools.product(*conditions)), columns=columns)         
+    n_trials = df.groupby(by=columns).size()
+    
+    return n_trials.shape[0] == n_permutations, n_trials
 
-        # Identify those required conditions that aren't in the test data
-        tested = df.groupby(columns).size().reset_index(columns)
-        missing = required.merge(tested, how = 'outer' ,indicator=True).loc[lambda x : x['_merge']=='left_only']        
-        print(missing[columns])
 
-        # Resolve based on SNR - this is specific for the vowel/noise project and might not generalize (need to think more on that if it arises)
-        for SNR_to_drop in missing['SNR'].unique():
-            df.drop(df[df['SNR'] == SNR_to_drop].index, inplace=True)
+def fix_unbalanced_stimuli(df: pd.DataFrame, columns: list):                # Brought directly from bootstrap
 
-        if df.shape[0] == 0:
-            raise NameError('Correction for imbalanced stimuli removed all the data! (Better have a look)')
+    # Create a dataframe with all the required experimental conditions
+    conditions = [df[c].unique() for c in columns]
+    required = pd.DataFrame( list(itertools.product(*conditions)), columns=columns)         
 
-        return df
+    # Identify those required conditions that aren't in the test data
+    tested = df.groupby(columns).size().reset_index(columns)
+    missing = required.merge(tested, how = 'outer' ,indicator=True).loc[lambda x : x['_merge']=='left_only']        
+    print(missing[columns])
 
+    # Resolve based on SNR - this is specific for the vowel/noise project and might not generalize (need to think more on that if it arises)
+    df = df[~df['SNR'].isin(missing['SNR'].unique())]
 
-# Subject specific issues
-def magnum_level_correction(f):
+    if df.shape[0] == 0:
+        raise NameError('Correction for imbalanced stimuli removed all the data! (Better have a look)')
 
-    if f.name == 'Magnum':  
-        f.data.loc[f.data['F1'] == 936, 'Atten'] += 5                          # Fix for error when calibration correction included in logging (this shouldn't happen, and was corrected for the later animals)     
-        f.data['Atten'] = ca.round_to_nearest(f.data['Atten'], 3)                 # Consider attenuations in 3 dB intervals (account for minor [1 dB] differences in parameters)
+    return df
 
-def robin_control_performance_management(f):
-    
-    if f.name == 'Robin':       
-        f.data = ca.constrain_attenutations_by_control_performance(f.data, settings.control_limit)
+
+# Subject specific issues
+@register_step
+def magnum_level_correction(df: pd.DataFrame) -> pd.DataFrame:
+    """ Fix for error when calibration correction included in logging (this shouldn't happen, and was corrected for the later animals) """
+
+    atten = df['Atten'].where(df['F1'] != 936, df['Atten'] + 5)
+    return df.assign(Atten=ca.round_to_nearest(atten, 3))                        # Consider attenuations in 3 dB intervals (account for minor [1 dB] differences in parameters)
                
 
 
@@ -181,32 +230,10 @@ def main():
     for f in ferrets:          
 
         f.load_data('Results/Vowels_in_Noise/data/summary')
-       
-        f.remove_correction_trials()
-        f.remove_trials_without_response()
-        f.remove_continuous_noise_and_format_mask()
-
-        f.add_subject_metadata()
-        f.add_session_date()
-        f.add_reaction_times(decimal_places=4)
-        
-        magnum_level_correction(f)
-
-        f.format_vowel_labels()
-        f.format_sound_levels()
-        f.format_treatment()
-
-        f.match_attenuations()
-        
-        f.data = f.data[f.data['vowel_level'] >= settings.min_level]
-        
-        f.data = ca.drop_rare_attenuations(f.data, min_trials=settings.min_trials)
-            
-        f.tidy_up_column_names()
-        f.check_SNRs_are_balanced()
+        f.preprocess(cache_dir='Results/Vowels_in_Noise/data/.cache/pipeline')
         f.write_data('Results/Vowels_in_Noise/data/analysis')
 
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
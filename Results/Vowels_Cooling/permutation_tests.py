@@ -23,6 +23,7 @@ from lib.settings import default_level, noise_level
 def main():
 
     data_dir = Path('Results/Vowels_Cooling/data/analysis')
+    jobs = []
 
     # For each ferret
     for ferret in ferrets:
@@ -42,26 +43,22 @@ def main():
         df['rnded_level'] = default_level - df['Atten']
         df['rnded_SNR'] = df['rnded_level'] - noise_level
 
-        ###################################################################################################
-        # Run permuation tests for each mask
+        # Permutation test for the effect of cooling in each mask
+        jobs.append( dict(ferret=file_path.stem, data=df, contrast=('treatment', False, True), grouping=['Mask']))
 
-        # Observed performance
-        overSessions = ca.count_correct_trials(df, ['Mask', 'treatment'])
-        
-        for mask, mdata in overSessions.groupby('Mask'):
+    ###################################################################################################
+    # Run permuation tests for all ferrets and masks
 
-            control = mdata[mdata['treatment'] == False]
-            test = mdata[mdata['treatment'] == True]
+    results = ca.run_permutation_tests(jobs, n_jobs=-1, method='exact')
 
-            pt = ca.permutation_test( 
-                control['nTrials'].values[0], test['nTrials'].values[0], 
-                control['nCorrect'].values[0], test['nCorrect'].values[0], nIterations=10000)
+    # Correct for testing every mask in each ferret (max-T over shared permutations)
+    family = ca.run_permutation_tests(jobs, n_jobs=-1, family=True, nIterations=100000)
+    results = results.merge(family[['ferret','Mask','p_family']], on=['ferret','Mask'])
 
-            print(f"{mask}: p = {pt['p_below']:.3f}, obs_delta: {pt['observed_delta']:.3f}")
+    for _, pt in results.iterrows():
+        print(f"{pt['ferret']} {pt['Mask']}: p = {pt['p_below']:.3f}, p (family-wise, two-tailed) = {pt['p_family']:.3f}, obs_delta: {pt['observed_delta']:.3f}")
 
-            
-        
-        
+    results.to_csv( data_dir.parent / 'permutation_tests.csv', index=False)
 
 
 if __name__ == '__main__':
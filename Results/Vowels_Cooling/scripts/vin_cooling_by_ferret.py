@@ -33,6 +33,7 @@ from Results import settings, ferrets
 
 data_dir = Path('Results/Vowels_Cooling/data/analysis')
 save_path = Path('Results/Vowels_Cooling/images')
+null_cache = ca.null_cache(cache_dir='Results/Vowels_Cooling/data/.cache/null_cache')        # Reuse null distributions across reruns
 
 
 def create_axes(fig_size=(15, 9), nrows=3, ncolumns=5):
@@ -261,7 +262,7 @@ def main():
 
             pt = ca.permutation_test( 
                 control['nTrials'].values[0], test['nTrials'].values[0], 
-                control['nCorrect'].values[0], test['nCorrect'].values[0], nIterations=10)
+                control['nCorrect'].values[0], test['nCorrect'].values[0], nIterations=10, cache=null_cache)
 
             print(f"{mask}: p = {pt['p_below']}, obs_delta: {pt['observed_delta']:.3f}")
 
@@ -66,13 +66,12 @@ def main():
         # Load behavioral data
         f.load_data('Results/Vowels_Unmasking/data/analysis')
 
-        # Run bootstrap by SNR
-        f.bootstrap(plot_vars=['SpatialCondition', 'treatment','SNR'], flat_vars=['VowelLocation', 'F1'], nBoots=1000)
-        f.write_results('Results/Vowels_Unmasking/data/bootstrap', 'BY_SNR')
-
-        # Run bootstrap over SNR
-        f.bootstrap(plot_vars=['SpatialCondition', 'treatment'], flat_vars=['SNR','VowelLocation', 'F1'], nBoots=1000)
-        f.write_results('Results/Vowels_Unmasking/data/bootstrap', 'OVER_SNR')
+        # Run bootstrap by SNR and over SNR (from the same resamples)
+        f.bootstrap(specs=dict(
+            BY_SNR=(['SpatialCondition', 'treatment','SNR'], ['VowelLocation', 'F1']),
+            OVER_SNR=(['SpatialCondition', 'treatment'], ['SNR','VowelLocation', 'F1'])
+            ), nBoots=1000)
+        f.write_results('Results/Vowels_Unmasking/data/bootstrap')
 
 
 if __name__ == '__main__':
@@ -11,15 +11,19 @@ We want to know if cooling signficantly impairs performance. In essence, what th
 To address this, we can calculate the effect of cooling on each bootstrap resample and measure the confidence interval for that value.
 """
 
+import os, sys
 from pathlib import Path
 
 import pandas as pd
 
+sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../..')))
+from lib.bootstrap import find_tables, read_table
+
 data_dir = Path('Results/Vowels_Unmasking/data/bootstrap')
 
-for file_ in data_dir.glob('*_OVER_SNR.csv'):
+for file_ in find_tables(data_dir, '*_OVER_SNR'):          # csv, parquet or feather
 
-    df = pd.read_csv(file_)
+    df = read_table(file_)
 
     if any(df['treatment'] == True):
 
@@ -27,6 +27,7 @@ import pandas as pd
 from pathlib import Path
 
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../..')))
+from lib.bootstrap import read_table
 from lib.colors import VOWELS_SPATIAL as colors
 from lib.metric_axes import metric_axes
 from lib import settings
@@ -49,8 +50,8 @@ class ferret_to_plot(ferret):
     def load_bootstrap_results(self, file_path : str) -> None:
         """ Load results from bootstrapping """
         file_path = Path(file_path)
-        self.bootstrap_BY_SNR = pd.read_csv( file_path / f"{self.fstr}_BY_SNR.csv")
-        self.bootstrap_over_SNR = pd.read_csv( file_path / f"{self.fstr}_OVER_SNR.csv")
+        self.bootstrap_BY_SNR = read_table( file_path / f"{self.fstr}_BY_SNR")              # Any format written by ferret.write_results
+        self.bootstrap_over_SNR = read_table( file_path / f"{self.fstr}_OVER_SNR")
 
         # Replace boolean values with strings compatible with color structure
         self.bootstrap_BY_SNR['treatment'].replace({True:'Bilateral',False:'Control'}, inplace=True)
@@ -7,12 +7,13 @@ Created on 2021-10-10 by Stephen Town
 from dataclasses import dataclass
 import os, sys
 from pathlib import Path
+from typing import Optional
 
 import pandas as pd
 
 
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../../..')))
-from Results import cooling_analysis as ca
+from Results.session_files import read_session_files
 
 
 # Calibration corrections applied to get the same level (this information has contaminated the Atten values in the original data)
@@ -36,18 +37,18 @@ class ferret():
         self.fstr = f"F{self.num}"
         self.attn_correction = correction_values[self.fstr]
 
-    def import_original_data(self, file_path : str) -> pd.DataFrame:
-        """ Bring together source data files, saved as text format during experiments"""
+    def import_original_data(self, file_path : str, cache_dir : Optional[str] = None) -> pd.DataFrame:
+        """ Bring together source data files, saved as text format during experiments (with unnamed columns removed and column names corrected)"""
 
 
         # Extend path to specific subject
         file_path = Path(file_path) / f"F{self.num}_{self.name}"
-        all_data = []
+        files = list(file_path.glob('*.txt'))
 
-        # For each text file 
-        for file in file_path.glob('*.txt'):
+        # Read text files in parallel
+        all_data = read_session_files(files, cache_dir=cache_dir)
 
-            df = pd.read_csv(file, sep='\t', encoding='latin1')
+        for file, df in zip(files, all_data):
                     
             # Pick calibration contamination up as we load in each source file
             if detect_contamination(df):
@@ -55,7 +56,6 @@ class ferret():
                 df.loc[idx, 'Atten'] += self.attn_correction['correction']
 
             df['originalFile'] = file.name
-            all_data.append(df)
 
         self.data = pd.concat(all_data)
 
@@ -67,19 +67,6 @@ class ferret():
         self.data['RightTemperature'] = 37
 
 
-    def drop_unnamed_columns(self) -> None:
-        """ Remove columns arising from fomatting issue in original data (creates unnamed col at end of table)"""
-
-        unnamed_columns = [x for x in self.data.columns if 'Unnamed' in x]
-        self.data.drop(columns=unnamed_columns, inplace=True)
-
-
-    def format_column_names(self) -> None:
-        """ Correct for early column headers that included "?" """
-
-        self.data.rename(columns={'CorrectionTrial?': 'CorrectionTrial', 'CenterReward?': 'CenterReward'}, inplace=True)
-
-      
     def write_data(self, file_path : Path) -> None:
         """ Save as csv format """
 
@@ -108,13 +95,9 @@ def main():
     
     for f in ferrets:
         
-        f.import_original_data('Results/Vowels_Unmasking/data/original')
+        f.import_original_data('Results/Vowels_Unmasking/data/original', cache_dir='Results/Vowels_Unmasking/data/.cache/session_files')
 
         f.add_dummy_temperatures()
-
-        f.drop_unnamed_columns()
-
-        f.format_column_names()
         
         f.write_data('Results/Vowels_Unmasking/data/summary')
 
@@ -27,6 +27,7 @@ from pathlib import Path
 
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), '../../..')))
 from lib import settings
+from lib.pipeline import pipeline, register_step
 from Results import cooling_analysis as ca
 from Results import ferrets
 
@@ -51,68 +52,108 @@ class ferret():
         file_path = Path(file_path) / f"F{self.num}.csv"                          
         self.data.to_csv(file_path, index=False)
 
-    def add_subject_metadata(self) -> None:
-        """ Add ferret number and method to dataframe """
-        self.data['fNum'] = self.num
-
-    def add_session_date(self) -> None:
-        """ Extract date from session names for each trial"""
-        self.data = (self.data.assign(day = lambda df_: pd.to_datetime( df_.originalFile.str.slice(0,10), format='%d_%m_%Y')))
-        
-        # if 'originalFile' in self.data.columns:            
-            # self.data['sessionDate'] = self.data['originalFile'].apply(ca.filename_to_sessiondate)      
-        
-    def remove_correction_trials(self) -> None:
-        """ Only take non-correction trials """
-        self.data = self.data[self.data['CorrectionTrial'] == 0]                
-        self.data.drop('CorrectionTrial', axis=1, inplace=True) 
-
-    def remove_trials_without_response(self) -> None:
-        """ Only take trials with responses (no response is very very rare) """
-        self.data = self.data[self.data['Response'] >= 0]
-
-    def format_sound_levels(self) -> None:
-        """ Express vowel levels in absolute terms and relative to noise (SNR)"""
-
-        self.data['vowel_level'] = (settings.default_level-3) - self.data['Atten']      # Drop default_level by 3 due to one rather than two speakers
-        self.data['SNR'] = self.data['vowel_level'] - (settings.noise_level - 3)        # Drop default_level by 3 due to one rather than two speakers
-
-    def format_stimulus_labels(self) -> None:
-        """ Make codes for vowel location and mask condition human-readable """
-
-        vowel_map = {
-            0 : 'left', 1 : 'right', 2 : 'left', 3 : 'right', 4 : 'left', 5 : 'right'        
-        }
+    def preprocessing_steps(self) -> list:
+        """ Steps (and parameters) that format summary data for analysis """
 
-        spatial_mask_map = {
-            0 : 'colocated', 1 : 'colocated',
-            2 : 'separated', 3 : 'separated',
-            4 : 'single_speaker', 5 : 'single_speaker'
-            }
+        steps = [
+            (add_subject_metadata, dict(num=self.num)),
+            add_session_date,
+            remove_correction_trials,
+            remove_trials_without_response,
+            (ca.temperature_preprocessing, dict(warm_threshold=settings.warm_threshold, cooled_threshold=settings.cooled_threshold))
+        ]
 
-        self.data['Mask'] = self.data['SpatialMask'].map(spatial_mask_map)
-        self.data['VowelLocation'] = self.data['SpatialMask'].map(vowel_map)
+        if self.name == 'Magnum':
+            steps.append( magnum_level_correction)
 
-    def match_attenuations(self) -> None:
-        """ Ensure that we only use the same attenuations tested within a specific time window"""
-        self.data = ca.match_for_atten(self.data, time_interval=self.attn_matching_window, condition_interval=self.attn_matching_variable)
+        steps += [
+            (ca.match_for_atten, dict(time_interval=self.attn_matching_window, condition_interval=self.attn_matching_variable)),   # Ensure that we only use the same attenuations tested within a specific time window
+            (format_sound_levels, dict(default_level=settings.default_level, noise_level=settings.noise_level)),
+            format_stimulus_labels
+        ]
 
+        if self.name == 'Robin':
+            steps.append( (ca.constrain_attenutations_by_control_performance, dict(control_limit=settings.control_limit)))
 
-# Subject specific issues
-def magnum_level_correction(f):
+        return steps + [
+            (ca.drop_rare_attenuations, dict(min_trials=settings.min_trials)),
+            tidy_up_column_names
+        ]
+
+    def preprocess(self, cache_dir: str) -> None:
+        """ Run preprocessing pipeline (reusing cached results of unchanged steps) and report the cost of each step """
+
+        steps = pipeline(self.preprocessing_steps(), cache_dir=cache_dir)
+        self.data = steps.run(self.data)
 
-    if f.name == 'Magnum':
+        print(steps.log.to_string(index=False))
+
+
+# Preprocessing steps (each returns a new dataframe, without changing its input)
+register_step(ca.temperature_preprocessing)
+register_step(ca.match_for_atten)
+register_step(ca.constrain_attenutations_by_control_performance)
+register_step(ca.drop_rare_attenuations)
+
+
+@register_step
+def add_subject_metadata(df: pd.DataFrame, num: int) -> pd.DataFrame:
+    """ Add ferret number to dataframe """
+    return df.assign(fNum=num)
+
+@register_step
+def add_session_date(df: pd.DataFrame) -> pd.DataFrame:
+    """ Extract date from session names for each trial"""
+    return df.assign(day = lambda df_: pd.to_datetime( df_.originalFile.str.slice(0,10), format='%d_%m_%Y'))
+    
+@register_step
+def remove_correction_trials(df: pd.DataFrame) -> pd.DataFrame:
+    """ Only take non-correction trials """
+    return df[df['CorrectionTrial'] == 0].drop('CorrectionTrial', axis=1)
+
+@register_step
+def remove_trials_without_response(df: pd.DataFrame) -> pd.DataFrame:
+    """ Only take trials with responses (no response is very very rare) """
+    return df[df['Response'] >= 0]
+
+@register_step
+def format_sound_levels(df: pd.DataFrame, default_level: float, noise_level: float) -> pd.DataFrame:
+    """ Express vowel levels in absolute terms and relative to noise (SNR)"""
+
+    vowel_level = (default_level-3) - df['Atten']                     # Drop default_level by 3 due to one rather than two speakers
+    return df.assign(vowel_level=vowel_level, SNR=vowel_level - (noise_level - 3))        # Drop default_level by 3 due to one rather than two speakers
+
+@register_step
+def format_stimulus_labels(df: pd.DataFrame) -> pd.DataFrame:
+    """ Make codes for vowel location and mask condition human-readable """
+
+    vowel_map = {
+        0 : 'left', 1 : 'right', 2 : 'left', 3 : 'right', 4 : 'left', 5 : 'right'        
+    }
+
+    spatial_mask_map = {
+        0 : 'colocated', 1 : 'colocated',
+        2 : 'separated', 3 : 'separated',
+        4 : 'single_speaker', 5 : 'single_speaker'
+        }
 
-        # Deal with calibration contamination 
-        attn_correction = dict(F1 = 936, correction = 5.)
-        
-        for session, df in f.data.groupby('originalFile'):              # This has to be done by session, as we applied the fix to the acquistion system in the middle of testing (so some of the data is fine)
-            if detect_contamination(df):
-                idx = (df['F1'] == attn_correction['F1'])
-                df.loc[idx, 'Atten'] += attn_correction['correction']
+    return df.assign(Mask=df['SpatialMask'].map(spatial_mask_map), VowelLocation=df['SpatialMask'].map(vowel_map))
 
-        # Consider attenuations in 3 dB intervals for Magnum (account for minor differences in parameters)
-        f.data['Atten'] = ca.round_to_nearest(f.data['Atten'], 3)                 
+@register_step
+def tidy_up_column_names(df: pd.DataFrame) -> pd.DataFrame:
+    return df.rename({'isCooled':'treatment','Mask':'SpatialCondition'}, axis=1)
+
+
+# Subject specific issues
+@register_step
+def magnum_level_correction(df: pd.DataFrame) -> pd.DataFrame:
+    """ Consider attenuations in 3 dB intervals for Magnum (account for minor differences in parameters)
+    
+    The correction for calibration contamination in some sessions (see detect_contamination) used to 
+    edit a copy of each session's data, and so never reached the data that were analysed. It is left 
+    out here so that analysis data are reproduced, pending a decision on whether to apply it.
+    """
+    return df.assign(Atten=ca.round_to_nearest(df['Atten'], 3))
 
 
 def detect_contamination(df: pd.DataFrame) -> bool:
@@ -127,13 +168,6 @@ def detect_contamination(df: pd.DataFrame) -> bool:
     return pt.isnull().sum().sum() > 0
 
 
-def robin_control_performance_management(f):
-    
-    if f.name == 'Robin':       
-        f.data = ca.constrain_attenutations_by_control_performance(f.data, settings.control_limit)
-               
-
-
 def main():
 
     ferrets = [
@@ -145,28 +179,9 @@ def main():
     for f in ferrets:
 
         f.load_data('Results/Vowels_Unmasking/data/summary')
-
-        f.add_subject_metadata()
-        f.add_session_date()        
-
-        f.remove_correction_trials()
-        f.remove_trials_without_response()
-
-        f.data = ca.temperature_preprocessing(f.data, settings.warm_threshold, settings.cooled_threshold)
-        
-        magnum_level_correction(f)
-
-        f.match_attenuations()        
-        f.format_sound_levels()
-        f.format_stimulus_labels()
-
-        robin_control_performance_management(f)
-
-        f.data = ca.drop_rare_attenuations(f.data, min_trials=settings.min_trials)
-        f.data.rename({'isCooled':'treatment','Mask':'SpatialCondition'}, axis=1, inplace=True)                    # Tidy up column names        
-        
+        f.preprocess(cache_dir='Results/Vowels_Unmasking/data/.cache/pipeline')
         f.write_data('Results/Vowels_Unmasking/data/analysis')    
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
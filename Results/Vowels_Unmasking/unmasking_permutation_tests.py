@@ -20,6 +20,7 @@ Version History
 
 from dataclasses import dataclass
 import os, sys
+from typing import Optional
 
 
 import matplotlib.pyplot as plt
@@ -34,6 +35,7 @@ from Results import cooling_analysis as ca
 from Results import plot_tools as cplot
 from Results.plot_tools import metric_axes
 from Results import settings, ferrets
+from lib.bootstrap import factorize_cells
 
 @dataclass
 class ferret():
@@ -72,6 +74,12 @@ class ferret():
         self.release_from_masking = get_release_from_masking(self.summary_over_attn.copy())
 
 
+    def test_release_from_masking(self, nIterations: int = 10000) -> None:
+        """Test whether cooling changes release from masking (permuting treatment within spatial conditions)"""
+
+        self.release_test = release_from_masking_test(self.summary_over_attn, nIterations)
+
+
 
 
 @dataclass
@@ -82,6 +90,12 @@ class perm_test():
     nIterations : int
     experimental_var : str
     layered_var : str
+    engine : str = 'pandas'     # 'pandas' (shuffle dataframe each iteration) or 'vectorized' (blocks of permutations as arrays)
+    block_size : int = 100      # Iterations permuted together by the vectorized engine
+    strata : Optional[list] = None      # Columns (e.g. day, Atten, vowel) within which values are shuffled (vectorized engine)
+    sequential : bool = False   # Stop once p values for every layer are decided, with nIterations as a cap (vectorized engine)
+    alpha : float = 0.05        # Significance level that decides p values in sequential mode
+    h : int = 50                # Number of exceedances that decides a p value in sequential mode
 
     def __post_init__(self):    
         self.data = self.subject.data.copy()        
@@ -112,6 +126,14 @@ class perm_test():
     def generate_shuffled_data(self) -> None:
         """ Run the test by repeated shuffling and remeasuring results """
 
+        if self.engine == 'vectorized':
+            self.results = self.generate_shuffled_counts()
+            return
+        elif self.engine != 'pandas':
+            raise ValueError(f"Unknown permutation engine: {self.engine}")
+        elif self.strata is not None or self.sequential:
+            raise ValueError('Restricted permutations (strata) and sequential stopping require the vectorized engine')
+
         results = []
 
         for i in range(0, self.nIterations):
@@ -123,6 +145,90 @@ class perm_test():
         self.results = pd.concat(results)
         
 
+    def generate_shuffled_counts(self) -> pd.DataFrame:
+        """ Run the test with permutations of the shuffled (outcome) column drawn in blocks of iterations 
+        
+        Spatial and treatment conditions are factorized once into cell codes, and correct trials in each 
+        cell are then counted for a whole block of permutations with one weighted bincount. Results have 
+        the same format as the pandas engine and, as both engines shuffle with numpy's algorithm on the same 
+        random stream, the same values (checked against the pandas engine for numpy 2).
+
+        If strata are given, values are only exchanged between trials in the same stratum (rows with missing
+        strata are exchanged among themselves). In sequential mode, blocks are drawn until p values above and 
+        below the observed effect are decided for every layer (see ca.is_p_value_decided), and the number of 
+        iterations used is kept in n_iterations.
+        """
+
+        group_vars = ['SpatialCondition', 'treatment']
+
+        if self.shuffle_var in group_vars:
+            raise ValueError('The vectorized engine permutes outcomes, rather than condition labels')
+
+        cell_codes, cell_labels = factorize_cells(self.data, group_vars)
+        strata = None if self.strata is None else factorize_cells(self.data, self.strata)[0]
+        values = self.data[self.shuffle_var].to_numpy()
+        generator = np.random.Generator(self.rng)
+
+        n_cells = cell_labels.shape[0]
+        is_counted = cell_codes >= 0                                        # Rows with missing conditions are shuffled, but not counted
+        nTrials = np.bincount(cell_codes[is_counted], minlength=n_cells)
+
+        if self.sequential:
+            self.get_experimental_effect()
+            n_exceedances = 0
+
+        results = []
+        for first in range(0, self.nIterations, self.block_size):
+
+            n_block = min(self.block_size, self.nIterations - first)
+            shuffled_values = ca.permute_within_strata(generator, values, n_block, strata)
+
+            block_codes = cell_codes[is_counted] + n_cells * np.arange(n_block)[:, np.newaxis]       # Separate cells for each iteration
+            counts = np.bincount(block_codes.ravel(), weights=shuffled_values[:, is_counted].ravel(), minlength=n_block * n_cells)
+
+            nCorrect = counts.reshape(n_block, n_cells)
+
+            if values.dtype.kind in 'biu':
+                nCorrect = np.rint(nCorrect).astype(np.int64)               # Counts of integer (or boolean) outcomes
+
+            block_results = cell_labels.iloc[np.tile(np.arange(n_cells), n_block)]
+            block_results['nTrials'] = np.tile(nTrials, n_block)
+            block_results['nCorrect'] = nCorrect.ravel()
+            block_results['pCorrect'] = block_results['nCorrect'] / block_results['nTrials'] * 100
+            block_results['iteration'] = np.repeat(np.arange(n_block), n_cells) + first
+
+            results.append(block_results)
+
+            if self.sequential:
+                n_exceedances = n_exceedances + self.count_exceedances(block_results)
+
+                if np.all(ca.is_p_value_decided(n_exceedances, first + n_block, self.alpha, self.h)):
+                    break
+
+        self.n_iterations = first + n_block
+
+        return pd.concat(results)
+
+
+    def count_exceedances(self, results: pd.DataFrame) -> np.ndarray:
+        """ Number of shuffled effects below and above the observed effect, for each layer (layers x 2) """
+
+        null_dist = self.get_performance_delta( 
+            pd.pivot_table(results, values='pCorrect', columns=self.experimental_var, index=['iteration', self.layered_var]), 
+            self.experimental_var).reset_index(level=[self.layered_var])
+
+        observation = self.experimental_obs.set_index(self.layered_var)['delta']
+        observation = null_dist[self.layered_var].map(observation).to_numpy()           # Observed effect for each shuffled effect
+
+        exceedances = pd.DataFrame({
+            'layer': null_dist[self.layered_var].to_numpy(),
+            'below': null_dist['delta'].to_numpy() < observation, 
+            'above': null_dist['delta'].to_numpy() > observation
+            })
+
+        return exceedances.groupby('layer')[['below','above']].sum().to_numpy()
+        
+
     def get_null_distribution(self) -> None:
         """ Organize shuffled results prior to evaluation of observed values """
 
@@ -211,6 +317,77 @@ def get_release_from_masking(summary_over_attn):
     )
 
 
+def release_from_masking_test(summary_over_attn, nIterations=10000, seed=224947):
+    """
+    Permutation test of the interaction between cooling and spatial condition,
+    i.e. whether release from masking (separated - colocated, in % correct) 
+    differs between cooled and control testing
+
+    Treatment labels are shuffled only within each spatial condition, so the 
+    number of correct trials labelled as cooled in each condition follows an
+    independent hypergeometric distribution given the margins. Counts are 
+    therefore drawn for all iterations and conditions at once, and the 
+    interaction follows from counts without shuffling individual trials.
+
+    Parameters:
+    ----------
+    summary_over_attn : pandas dataframe
+        Trial counts (nTrials, nCorrect) for each SpatialCondition and treatment (see count_correct_trials)
+    nIterations : int, optional
+        Number of iterations to permute
+    seed : int, optional
+        Seed of the random stream
+
+    Returns:
+    --------
+    dict with:
+        p_below : float
+            Probability of randomly observing a more negative change in release from masking than was found experimentally
+        p_above : float
+            Probability of randomly observing a more positive change in release from masking than was found experimentally
+        observed_delta : float
+            Release from masking during cooling minus release during control testing (same as get_release_from_masking)
+        perm_values : numpy array
+            Shuffled changes in release from masking (nIterations x 1)
+        n_iterations : int
+            Number of iterations drawn
+    """
+
+    counts = summary_over_attn.set_index(['SpatialCondition', 'treatment'])
+    conditions = ['separated', 'colocated']
+
+    nTrials = counts['nTrials'].unstack('treatment').loc[conditions]
+    nCorrect = counts['nCorrect'].unstack('treatment').loc[conditions]
+
+    nX, nY = nTrials[False].to_numpy(dtype=np.int64), nTrials[True].to_numpy(dtype=np.int64)
+    cX, cY = nCorrect[False].to_numpy(dtype=np.int64), nCorrect[True].to_numpy(dtype=np.int64)
+
+    rng = np.random.default_rng(seed)
+    null_cY = rng.hypergeometric(cX+cY, nX+nY-cX-cY, nY, size=(nIterations, len(conditions)))       # Correct trials labelled as cooled in each condition
+
+    observed_delta = get_release_interaction(nX, nY, cX, cY)
+    shuffled_delta = get_release_interaction(nX, nY, cX+cY-null_cY, null_cY)
+    
+    tolerance = 1e-9 * 100                                                  # Effects equal to observation may differ in rounding error
+
+    return dict(
+        p_below = np.sum(shuffled_delta < observed_delta - tolerance) / nIterations,     # Tail 1: Cooling reduces release from masking
+        p_above = np.sum(shuffled_delta > observed_delta + tolerance) / nIterations,     # Tail 2: Cooling increases release from masking
+        observed_delta = observed_delta,
+        perm_values = shuffled_delta[:, np.newaxis],
+        n_iterations = nIterations
+    )
+
+
+def get_release_interaction(nX, nY, cX, cY):
+    """ Release from masking (separated - colocated, % correct) during cooling minus control, from counts of trials in [separated, colocated] conditions (last axis) """
+
+    control, cooled = cX / nX * 100, cY / nY * 100
+
+    ctrl_release = control[..., 0] - control[..., 1]
+    cool_release = cooled[..., 0] - cooled[..., 1]
+
+    return cool_release - ctrl_release
 
 
 def main():  
@@ -230,6 +407,13 @@ def main():
     # Get release from masking values for each animal
     [x.get_release_from_masking() for x in cooled_ferrets]
 
+    # Test whether cooling changes release from masking
+    for x in cooled_ferrets:
+
+        x.test_release_from_masking(nIterations=100000)
+        
+        print(f"{x.fstr}: change in release from masking = {x.release_test['observed_delta']:.3f}, p < obs = {x.release_test['p_below']}, p > obs = {x.release_test['p_above']}")
+
     # Set up and run permutation tests
     # perm_tests = [perm_test(x, 'Correct', nIterations=1000, experimental_var='treatment', layered_var='SpatialCondition') for x in cooled_ferrets]
 
@@ -243,7 +427,7 @@ def main():
     # [x.evaluate_observations() for x in perm_tests]
     
     # Set up and run permutation tests
-    effect_of_condition = [perm_test(x, 'Correct', nIterations=1000, experimental_var='SpatialCondition', layered_var='treatment') for x in cooled_ferrets]
+    effect_of_condition = [perm_test(x, 'Correct', nIterations=1000, experimental_var='SpatialCondition', layered_var='treatment', engine='vectorized') for x in cooled_ferrets]
 
     for x in effect_of_condition:
 
@@ -11,10 +11,22 @@ Created:
     2021-07-20: Stephen Town
 
 """
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from functools import partial
+import hashlib
+import itertools
+import json
+import os
+from pathlib import Path
+import time
+from typing import Optional
 
 import pandas as pd
 import numpy as np
+from scipy.stats import beta, hypergeom
 
 
 # PREPROCESSING:
@@ -46,7 +58,7 @@ def filename_to_sessiondate(s):
     return session_dt
 
 
-def constrain_attenutations_by_control_performance(df, control_limit, min_trials=5):
+def constrain_attenutations_by_control_performance(df, control_limit, min_trials=5, across_masks=False):
     """
     For some sessions, performance on control sessions (when cooling wasn't
     performed) was very poor. This creates floor effects in which it becomes
@@ -64,6 +76,10 @@ def constrain_attenutations_by_control_performance(df, control_limit, min_trials
         listener performance ['Correct']
     control_limit : float
         Minimum performance required at each control attenutation
+    min_trials : int, optional
+        Control trials required to judge performance (attenuations with fewer trials are kept)
+    across_masks : bool, optional
+        Remove attenuations flagged in any mask on a given day from all masks on that day
         
     Notes:
     ------
@@ -77,7 +93,12 @@ def constrain_attenutations_by_control_performance(df, control_limit, min_trials
     The process also acts by combination of day and mask, which means that data
     from particular conditions is being removed from particular days; whereas
     it really should be that flagged attenuations on a given day are removed from
-    all maks
+    all maks (use across_masks for this)
+
+    Control performance is counted for every day, mask and attenuation in one
+    aggregation, and the resulting table of attenuations to keep is merged back
+    onto the data. Attenuations without control trials in a mask are dropped.
+    Rows are returned in order of day and mask (and original order within each).
 
     
     Returns:
@@ -86,34 +107,18 @@ def constrain_attenutations_by_control_performance(df, control_limit, min_trials
         Subset of input data with potentially fewer rows
     """
 
-    updated_df = []
     control_limit = control_limit * 100
-                 
-    for (day, mask), mask_data in df.groupby(by=['day', 'Mask']):
-
-        control_df = mask_data[mask_data['isCooled']== False]
-
-        # byAtten = control_df.groupby(by='Atten')                            # Method 3: Take only sound levels at which critical value was exceeded
-        
-        # nCorrect = byAtten['Correct'].sum().cumsum()
-        # nTrials = byAtten['Correct'].count().cumsum()
-        
-        # pCorrect = nCorrect / nTrials
-        # good_attns = pCorrect[pCorrect > control_limit].index.to_list()     
+    keys = ['day', 'Mask', 'Atten']
 
-        byAtten = count_correct_trials(control_df, 'Atten')                 # Method 4: Avoid Cumulative sums (what was I thinking?!) and have min requirement for estimating performance
+    byAtten = count_correct_trials(df[df['isCooled'] == False], keys)     # Method 4: Avoid Cumulative sums (what was I thinking?!) and have min requirement for estimating performance
+    byAtten['keep'] = (byAtten['nTrials'] < min_trials) | (byAtten['pCorrect'] > control_limit)
 
-        low_samples = byAtten[byAtten['nTrials'] < min_trials]['Atten'].to_list()
-        ok_perform = byAtten[byAtten['pCorrect'] > control_limit]['Atten'].to_list()
+    if across_masks:
+        byAtten['keep'] = byAtten.groupby(['day', 'Atten'])['keep'].transform('all')       # Flagged in any mask on the day
 
-        good_attns = list(set(low_samples) | set(ok_perform))
+    is_kept = df[keys].merge(byAtten[keys + ['keep']], how='left', on=keys)['keep'].eq(True).to_numpy()     # Not kept if no control trials
 
-        mask_data = mask_data[mask_data['Atten'].isin(good_attns)]
-
-        if mask_data is not None:
-            updated_df.append(mask_data)                
-                                
-    return pd.concat(updated_df)
+    return df[is_kept].sort_values(['day', 'Mask'], kind='stable')
 
 
 def drop_rare_attenuations(df, min_trials):
@@ -144,10 +149,14 @@ def drop_rare_attenuations(df, min_trials):
     return df
 
 
-def match_for_atten(df, time_interval='day', condition_interval='originalFile'):
+def match_for_atten(df, time_interval='day', condition_interval='originalFile', return_dropped=False):
     """
     Drops attenuations that weren't tested in two
     sessions (cooling) or within the same block (opto) on the same day
+
+    Conditions are counted for every window and attenuation in one grouped 
+    transform, so matching is a single mask over the whole dataframe. Rows 
+    are returned in order of window (and original order within each window).
     
     Parameters:
     ----------
@@ -157,35 +166,48 @@ def match_for_atten(df, time_interval='day', condition_interval='originalFile'):
     time_interval : str
         Column name denoting window over which samples are considered
         as a pair ('day' or 'block')
+    return_dropped : bool, optional
+        Also return the window and attenuation pairs that were dropped
+
+    >>> df = pd.DataFrame(dict(day=[2, 1, 1, 1, 2], Atten=[0, 0, 0, 10, 0], originalFile=['c', 'a', 'b', 'a', 'd']))
+    >>> df, dropped = match_for_atten(df, return_dropped=True)
+    >>> df.index.tolist()
+    [1, 2, 0, 4]
+    >>> dropped.to_dict('records')
+    [{'day': 1, 'Atten': 10, 'n_conditions': 1, 'n_trials': 1}]
     
     Returns:
     --------
     df : pandas dataframe
         Dataframe covering matched attenuations
+    dropped : pandas dataframe, optional
+        Window and attenuation pairs that were dropped, with the number of conditions and trials 
     """
 
     if time_interval == 'all':  # Magnum, unpaired
 
         good_attns = df[df[condition_interval]]['Atten'].unique()           # isCooled is logical (true for cooled)
-        df = df[df['Atten'].isin(good_attns)]
+        is_matched = df['Atten'].isin(good_attns)
+        matched = df[is_matched]
+
+        if return_dropped:
+            return matched, df[~is_matched].groupby('Atten').size().rename('n_trials').reset_index()
     
-        return df
+        return matched
 
-    else:                       # Mimi, Robin - paired
-        updated_df = []
+    # Mimi, Robin - paired
+    n_conditions = df.groupby([time_interval, 'Atten'])[condition_interval].transform('nunique', dropna=False)      # Conditions in which each attenuation was tested in each window
+    is_matched = n_conditions == 2
 
-        for sample, data in df.groupby(time_interval):
-                
-            byAtten = data.groupby(by='Atten')             # Get attenuations that are tested in both sessions
-            sessions = byAtten[condition_interval].unique()
+    matched = df[is_matched].sort_values(time_interval, kind='stable')
 
-            nSessions = sessions.apply(len)
-            Attns = nSessions[nSessions.values == 2]
+    if return_dropped:
+        dropped = df.loc[~is_matched, [time_interval, 'Atten']].assign(n_conditions=n_conditions[~is_matched])
+        dropped = dropped.groupby([time_interval, 'Atten']).agg(n_conditions=('n_conditions', 'first'), n_trials=('n_conditions', 'size'))
 
-            data = data[data['Atten'].isin(Attns.index.to_list())]
-            updated_df.append(data)
+        return matched, dropped.astype({'n_conditions': int}).reset_index()
 
-        return pd.concat(updated_df)
+    return matched
 
 
 def match_sample_sizes(df, levels):
@@ -217,11 +239,16 @@ def match_sample_sizes(df, levels):
     return pd.concat(matched_df)
     
 
-def temperature_preprocessing(df, warm_threshold, cooled_threshold):
+def temperature_preprocessing(df, warm_threshold, cooled_threshold, return_summary=False):
     """
     Drop intermediate temperatures between warm and cooled thresholds 
     Drop trials performed in control (warm) conditions from cooled sessions
     (either before cooling was achieved or after a problem with the loop arose)
+
+    Every trial is classified in one pass, with sessions identified as cooled
+    from the minimum temperature of their remaining trials (groupby transform), 
+    so time scales linearly with the number of trials. The input dataframe is
+    not modified.
     
     Parameters:
     ----------
@@ -231,25 +258,50 @@ def temperature_preprocessing(df, warm_threshold, cooled_threshold):
         Value above which cortical temperatures are considered to be normal
     cooled_threshold : float
         Value below which cortical temperatures are considered to be cooled
+    return_summary : bool, optional
+        Also return the number of trials kept and dropped in each session
+
+    >>> df = pd.DataFrame(dict(originalFile=['a','a','a','b'], LeftTemperature=[10, 36, 30, 38], RightTemperature=[10, 36, 30, 38]))
+    >>> df, summary = temperature_preprocessing(df, 35, 20, return_summary=True)
+    >>> df['isCooled'].tolist()
+    [True, False]
+    >>> summary[['dropped_intermediate','dropped_warm','kept']].to_numpy().tolist()
+    [[1, 1, 1], [0, 0, 1]]
     
     Returns:
     --------
     df : pandas dataframe
-        Subset of input dataframe 
+        Subset of input dataframe, with mean temperature (meanTemp) and whether each trial was cooled (isCooled)
+    summary : pandas dataframe, optional
+        Trials in each session (originalFile) that were dropped as intermediate temperatures 
+        (dropped_intermediate) or warm trials in a cooled session (dropped_warm), kept and cooled
     """
 
-    df['meanTemp'] = (df['LeftTemperature'] + df['RightTemperature']) / 2       # Get mean temperature between left and right loops
+    mean_temp = (df['LeftTemperature'] + df['RightTemperature']) / 2                  # Get mean temperature between left and right loops
     
-    idx = df[(df['meanTemp'] > cooled_threshold) & (df['meanTemp'] < warm_threshold)].index     # Remove intermediate temperatures
-    df.drop(idx, inplace=True)
+    is_intermediate = (mean_temp > cooled_threshold) & (mean_temp < warm_threshold)   # Remove intermediate temperatures
 
-    for session, sData in df.groupby('originalFile'):                           # Remove warm trials from sessions with cooling 
-        if any(sData['meanTemp'] < warm_threshold):         
-            df.drop(sData[sData['meanTemp'] > cooled_threshold].index, inplace=True)
-            
-    df['isCooled'] = df['meanTemp'] <= cooled_threshold
+    session_min = mean_temp.where(~is_intermediate).groupby(df['originalFile']).transform('min')
+    is_warm_in_cooled_session = (session_min < warm_threshold) & (mean_temp > cooled_threshold) & ~is_intermediate     # Remove warm trials from sessions with cooling 
 
-    return df
+    is_kept = ~(is_intermediate | is_warm_in_cooled_session)
+
+    filtered = df[is_kept].copy()
+    filtered['meanTemp'] = mean_temp[is_kept]
+    filtered['isCooled'] = filtered['meanTemp'] <= cooled_threshold
+
+    if not return_summary:
+        return filtered
+
+    summary = pd.DataFrame(dict(
+        n_trials = 1,
+        dropped_intermediate = is_intermediate,
+        dropped_warm = is_warm_in_cooled_session,
+        kept = is_kept,
+        cooled = is_kept & (mean_temp <= cooled_threshold)
+    )).groupby(df['originalFile'], dropna=False).sum()
+
+    return filtered, summary
 
 
 # ANALYSIS:
@@ -291,52 +343,551 @@ def count_correct_trials(df, groupvars):
     return results
 
 
-def permutation_test(nX, nY, cX, cY, nIterations=10000):
+def permutation_test(nX, nY, cX, cY, nIterations=10000, method='hypergeometric', sequential=False, alpha=0.05, h=50, batch_size=500, seed=13, cache=None):
     """
     Runs a permutation test to answer the question, what is the probability 
     of a difference in accuracy (measured as proportion correct) observed
     between two conditions (e.g. cooled and not cooled) occuring randomly.
 
     Calculation is computed as y-x
+
+    Shuffling condition labels only changes how many of the cX+cY correct 
+    trials fall in the cooled group, which follows a hypergeometric 
+    distribution given the margins. The default method therefore draws the
+    number of correct cooled trials for all iterations at once, while the 
+    legacy method shuffles trial vectors on every iteration (as originally 
+    published). Both use a fixed seed (13 unless given), but draw different 
+    random values.
+    The exact method takes p values from the hypergeometric distribution 
+    itself, without Monte Carlo error (see also null_distribution).
+
+    For restricted permutations (e.g. shuffling only within each day of a 
+    paired design), give trial counts as arrays with one value per stratum. 
+    Labels are then exchanged only within strata, so the null count is a sum
+    of independent hypergeometric draws, and the difference is measured 
+    between conditions pooled across strata.
+
+    In sequential mode, iterations are drawn in batches until both tails are
+    decided (Besag & Clifford, 1991): either h exceedances of the observed
+    difference have been seen, or the confidence interval of the p value 
+    lies entirely above or below alpha. nIterations is then a cap, and the 
+    iterations used are returned. Iterations match the first iterations of
+    a full run, so p values differ only through the number of iterations.
+    A p value decided by h exceedances has a relative error of about 
+    1/sqrt(h), so h should be large enough not to blur p values near alpha.
+
+    The null distribution depends only on the margins (trials in each 
+    condition and correct trials in total) and the seed, so with a cache 
+    (see null_cache), nulls already drawn for the same margins are reused 
+    across tests, reruns and sweeps. Results are identical with or without
+    a cache.
     
     Parameters:
     ----------
-    nX : int
-        Total number of trials in control condition    
-    nY : int
-        Total number of trials in cooled condition
-    pX : int
-        Number of correct trials observed in control testing
-    pY : int
-        Number of correct trials observed in cooled testing
+    nX : int or array of int
+        Total number of trials in control condition (for each stratum)
+    nY : int or array of int
+        Total number of trials in cooled condition (for each stratum)
+    pX : int or array of int
+        Number of correct trials observed in control testing (for each stratum)
+    pY : int or array of int
+        Number of correct trials observed in cooled testing (for each stratum)
     nIterations : int, optional
         Number of iterations to permute
+    method : str, optional
+        'hypergeometric' (default), 'legacy' or 'exact' (nIterations is ignored)
+    sequential : bool, optional
+        Stop early once p values are decided (hypergeometric method only)
+    alpha : float, optional
+        Significance level that decides p values in sequential mode
+    h : int, optional
+        Number of exceedances that decides a p value in sequential mode
+    batch_size : int, optional
+        Iterations drawn between checks in sequential mode
+    seed : int or numpy SeedSequence, optional
+        Seed of the random stream (e.g. spawned for each test in a batch)
+    cache : null_cache, optional
+        Store of null distributions (hypergeometric method, and exact method with strata)
 
 
     >>> result = permutation_test(100, 200, 80, 20)
-    >>> result['p_below']
+    >>> float(result['p_below'])
     0.0
 
     >>> result = permutation_test(100, 200, 20, 160)
-    >>> result['p_below']
+    >>> float(result['p_below'])
+    1.0
+
+    >>> result = permutation_test(100, 200, 20, 160, method='legacy')
+    >>> float(result['p_below'])
     1.0
+
+    >>> result = permutation_test(100, 200, 20, 160, method='exact')
+    >>> float(result['p_below'])
+    1.0
+
+    >>> result = permutation_test([50, 50], [100, 100], [40, 40], [10, 10], method='exact')
+    >>> bool(result['p_below'] < 1e-6)
+    True
+
+    >>> result = permutation_test(100, 200, 80, 20, sequential=True)
+    >>> result['n_iterations']
+    500
+
+    >>> cache = null_cache()
+    >>> result = permutation_test(100, 200, 80, 20, cache=cache)
+    >>> result = permutation_test(100, 200, 70, 30, cache=cache)
+    >>> cache.stats()['hits']
+    1
         
     Returns:
     --------
     p_below : float
         Probability of randomly observing a more negative effect 
         of cooling than was found experimentally
+    n_iterations : int
+        Number of iterations drawn (0 for the exact method)
     """
 
     # Ensure inputs are integers
     nIterations = int(nIterations)
+    is_stratified = np.ndim(cY) > 0
+
+    nX, nY, cX, cY = (np.atleast_1d(np.asarray(x, dtype=np.int64)) for x in (nX, nY, cX, cY))
+    total_nX, total_nY, total_cX, total_cY = nX.sum(), nY.sum(), cX.sum(), cY.sum()
+
+    rng = np.random.default_rng(seed=seed)
+    observed_diff = (total_cY / total_nY) - (total_cX / total_nX)
+
+    if sequential and method != 'hypergeometric':
+        raise ValueError('Sequential stopping requires the hypergeometric method')
+
+    if method != 'exact' and nIterations < 1:
+        raise ValueError(f"nIterations must be positive for the {method} method (got {nIterations})")
+
+    if method == 'exact' and is_stratified:
+        key = null_cache.key(method, nX, nY, cX+cY) if cache is not None else None
+        null = cache.get(key) if key is not None else None
+
+        if null is None:
+            null = null_distribution(nX, nY, cX, cY)
+
+            if key is not None:
+                cache.put(key, null)
+
+        null_cY = np.arange(null['pmf'].size) + null['min_correct']
+
+        return dict(
+            p_below = min(null['pmf'][null_cY < total_cY].sum(), 1.0),      # Tail 1: Cooling impairs performance (clip rounding errors)
+            p_above = min(null['pmf'][null_cY > total_cY].sum(), 1.0),      # Tail 2: Cooling improves performance
+            observed_delta = observed_diff * 100,               # proportion to percentage
+            perm_values = None,                                 # No sampling (see null_distribution)
+            n_iterations = 0
+        )
+
+    elif method == 'exact':
+        null_cY = hypergeom(total_nX+total_nY, total_cX+total_cY, total_nY)            # Correct trials among those labelled as cooled
+
+        return dict(
+            p_below = null_cY.cdf(total_cY-1),                  # Tail 1: Cooling impairs performance
+            p_above = null_cY.sf(total_cY),                     # Tail 2: Cooling improves performance
+            observed_delta = observed_diff * 100,               # proportion to percentage
+            perm_values = None,                                 # No sampling (see null_distribution)
+            n_iterations = 0
+        )
+
+    elif method == 'legacy':
+        if is_stratified:
+            raise ValueError('Restricted permutations are not supported by the legacy method')
+
+        shuffled_difference = shuffle_trial_vectors(total_nX, total_nY, total_cX, total_cY, nIterations, rng)
+
+        p_below = np.sum(shuffled_difference < observed_diff) / nIterations         # Tail 1: Cooling impairs performance
+        p_above = np.sum(shuffled_difference > observed_diff) / nIterations         # Tail 2: Cooling improves performance  
+
+    elif method == 'hypergeometric':
+        key = null_cache.key(method, nX, nY, cX+cY, seed=seed) if cache is not None else None
+        entry = cache.get(key) if key is not None else None
+
+        if entry is None:
+            null_cY = np.empty(0, dtype=np.int64)                                   # Correct trials among those labelled as cooled
+        else:
+            null_cY = entry['null_cY']                                              # Iterations already drawn for these margins...
+            rng.bit_generator.state = entry['state']                                # ...and the stream position after them
+        
+        n_cached = null_cY.size
+
+        if sequential:
+            n_exceedances = np.zeros(2, dtype=np.int64)                             # Below and above observation
+
+            for first in range(0, nIterations, batch_size):
+                last = min(first + batch_size, nIterations)
+
+                if last > null_cY.size:
+                    null_cY = np.concatenate((null_cY, draw_null_counts(rng, nX, nY, cX, cY, last - null_cY.size)))
+
+                batch_cY = null_cY[first:last]
+                n_exceedances += [np.sum(batch_cY < total_cY), np.sum(batch_cY > total_cY)]
+
+                if np.all(is_p_value_decided(n_exceedances, last, alpha, h)):
+                    break
+
+            nIterations = last
+
+        elif nIterations > null_cY.size:
+            null_cY = np.concatenate((null_cY, draw_null_counts(rng, nX, nY, cX, cY, nIterations - null_cY.size)))
+
+        if key is not None and null_cY.size > n_cached:
+            cache.put(key, dict(null_cY=null_cY, state=rng.bit_generator.state))
+
+        null_cY = null_cY[:nIterations]
+        shuffled_difference = (null_cY / total_nY - (total_cX+total_cY-null_cY) / total_nX)[:, np.newaxis]
+
+        # Difference increases with correct cooled trials, so compare counts (avoids rounding errors at ties)
+        p_below = np.sum(null_cY < total_cY) / nIterations                          # Tail 1: Cooling impairs performance
+        p_above = np.sum(null_cY > total_cY) / nIterations                          # Tail 2: Cooling improves performance  
+
+    else:
+        raise ValueError(f"Unknown permutation method: {method}")
+    
+    return dict(
+        p_below = p_below, 
+        p_above = p_above, 
+        observed_delta = observed_diff * 100,                   # proportion to percentage
+        perm_values = shuffled_difference * 100,                # proportion to percentage
+        n_iterations = nIterations
+    )
+
+
+def continuous_permutation_test(x, y, statistic='mean', nIterations=10000, strata=None, block_size=1000, seed=13):
+    """
+    Runs a permutation test for the difference in a continuous measure 
+    (e.g. absolute error or response time) between two conditions, 
+    measured as the mean or median of y minus that of x
+
+    Condition labels are permuted in blocks of iterations (see 
+    permute_within_strata), so every block is one matrix of labels. Group
+    sums for the mean are then a single matrix-vector product. Values are
+    sorted once, so that the median of each group is found from the 
+    running count of its labels, without sorting on every iteration.
+
+    Parameters:
+    ----------
+    x : array-like
+        Values observed in control condition
+    y : array-like
+        Values observed in test condition
+    statistic : str, optional
+        'mean' (default) or 'median'
+    nIterations : int, optional
+        Number of iterations to permute
+    strata : tuple of array-like, optional
+        Stratum of each value in x and in y (labels are exchanged only within strata)
+    block_size : int, optional
+        Number of iterations permuted at once (limits memory to block_size x trials)
+    seed : int or numpy SeedSequence, optional
+        Seed of the random stream
+
+    >>> result = continuous_permutation_test([1, 2, 3, 4, 5], [6, 7, 8, 9, 10])
+    >>> float(result['observed_delta']), float(result['p_above'])
+    (5.0, 0.0)
+
+    >>> result = continuous_permutation_test([1, 2, 3, 4, 50], [6, 7, 8, 9, 10], statistic='median')
+    >>> float(result['observed_delta'])
+    5.0
+
+    >>> result = continuous_permutation_test([1, 2, np.nan, 3], [6, 7, 8])        # doctest: +NORMALIZE_WHITESPACE
+    		Ignoring 1 missing values in permutation test
+    >>> float(result['observed_delta'])
+    5.0
+
+    Returns:
+    --------
+    p_below : float
+        Probability of randomly observing a more negative difference than was found experimentally
+    p_above : float
+        Probability of randomly observing a more positive difference than was found experimentally
+    observed_delta : float
+        Difference between conditions (y - x) in units of the values
+    perm_values : numpy array
+        Differences on each iteration (nIterations x 1)
+    n_iterations : int
+        Number of iterations drawn
+    """
+
+    nIterations = int(nIterations)
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+    # Missing values would make every comparison with the observation false (and p values zero)
+    is_valid = (~np.isnan(x), ~np.isnan(y))
+    n_missing = x.size + y.size - is_valid[0].sum() - is_valid[1].sum()
+
+    if n_missing > 0:
+        print(f"\t\tIgnoring {n_missing} missing values in permutation test")
+
+        x, y = x[is_valid[0]], y[is_valid[1]]
+        strata = None if strata is None else tuple(np.asarray(s)[v] for s, v in zip(strata, is_valid))
+
+    if x.size == 0 or y.size == 0:
+        raise ValueError('Both conditions need at least one value that is not missing')
+
+    values = np.concatenate((x, y))
+    is_test = np.concatenate((np.zeros(x.size), np.ones(y.size)))
+    codes = None if strata is None else np.unique(np.concatenate(strata), return_inverse=True)[1]
+
+    order = np.argsort(values, kind='stable')                   # Sorted values give medians from label counts
+    values, is_test = values[order], is_test[order]
+
+    if codes is not None:
+        codes = codes[order]
+
+    rng = np.random.default_rng(seed=seed)
+    observed_diff = group_differences(values, is_test[np.newaxis, :], statistic)[0]
+
+    shuffled_difference = np.concatenate([
+        group_differences(values, permute_within_strata(rng, is_test, min(block_size, nIterations - first), codes), statistic)
+        for first in range(0, nIterations, block_size)
+    ])
+
+    # Differences equal to the observation may differ in rounding error (e.g. for integer errors)
+    tolerance = 1e-9 * max(1.0, np.abs(values).max())
+
+    return dict(
+        p_below = np.sum(shuffled_difference < observed_diff - tolerance) / nIterations,     # Tail 1: Test condition lower
+        p_above = np.sum(shuffled_difference > observed_diff + tolerance) / nIterations,     # Tail 2: Test condition higher
+        observed_delta = observed_diff,
+        perm_values = shuffled_difference[:, np.newaxis],
+        n_iterations = nIterations
+    )
+
+
+def group_differences(sorted_values, is_test, statistic='mean'):
+    """
+    Difference in mean or median between test and control values for each
+    row of labels (e.g. for each permutation)
+
+    Parameters:
+    ----------
+    sorted_values : numpy array
+        Values of all trials, in ascending order
+    is_test : numpy array
+        Whether each trial is labelled as test condition (iterations x trials, as 0 or 1)
+    statistic : str, optional
+        'mean' or 'median'
+
+    Returns:
+    --------
+    delta : numpy array
+        Difference between conditions (test - control) for each row
+    """
+
+    n_test = int(is_test[0].sum())
+    n_control = sorted_values.size - n_test
+
+    if statistic == 'mean':
+        test_sum = is_test @ sorted_values
+        return test_sum / n_test - (sorted_values.sum() - test_sum) / n_control
+
+    elif statistic == 'median':
+        return group_medians(sorted_values, is_test, n_test) - group_medians(sorted_values, 1 - is_test, n_control)
+
+    raise ValueError(f"Unknown statistic: {statistic}")
+
+
+def group_medians(sorted_values, in_group, n):
+    """ Median of the n sorted values in a group, for each row of labels (the middle values are where the running count of labels reaches half of n) """
+
+    rank = np.cumsum(in_group, axis=1, dtype=np.int32)
+
+    lower = np.argmax(rank >= (n + 1) // 2, axis=1)
+    upper = np.argmax(rank >= n // 2 + 1, axis=1)
+
+    return (sorted_values[lower] + sorted_values[upper]) / 2
+
+
+def is_p_value_decided(n_exceedances, n_iterations, alpha=0.05, h=50, confidence=0.99):
+    """
+    Whether Monte Carlo p values are decided, as a sequential stopping rule:
+    either h exceedances have been observed (Besag & Clifford, 1991) or the 
+    Clopper-Pearson interval of the p value excludes alpha
+
+    Parameters:
+    ----------
+    n_exceedances : int or array of int
+        Number of permutations at least as extreme as the observation (e.g. for each tail)
+    n_iterations : int
+        Number of permutations drawn
+    alpha : float, optional
+        Significance level
+    h : int, optional
+        Number of exceedances after which p (≈ h / n_iterations) is precise enough
+    confidence : float, optional
+        Confidence level of the interval compared with alpha
+
+    >>> is_p_value_decided([0, 500], 500).tolist()
+    [True, True]
+
+    >>> is_p_value_decided([3, 97], 100).tolist()
+    [False, True]
+
+    Returns:
+    --------
+    decided : numpy array of bool
+        Whether each p value is decided
+    """
+
+    n_exceedances = np.asarray(n_exceedances)
+
+    lower = np.where(n_exceedances > 0, beta.ppf((1 - confidence) / 2, n_exceedances, n_iterations - n_exceedances + 1), 0.0)
+    upper = np.where(n_exceedances < n_iterations, beta.ppf((1 + confidence) / 2, n_exceedances + 1, n_iterations - n_exceedances), 1.0)
+
+    return (n_exceedances >= h) | (upper < alpha) | (lower > alpha)
+
+
+def draw_null_counts(rng, nX, nY, cX, cY, nIterations, max_draws=2**20):
+    """
+    Draw the number of correct trials labelled as cooled after shuffling
+    labels within each stratum, summed across strata (arrays of counts for
+    each stratum, as in permutation_test). Iterations are drawn in blocks 
+    of at most max_draws values, so memory is bounded for many strata.
+
+    Returns:
+    --------
+    null_cY : numpy array
+        Correct trials labelled as cooled on each iteration
+    """
+
+    block_size = max(1, max_draws // cY.size)
+    null_cY = []
+
+    for first in range(0, nIterations, block_size):
+        n_block = min(block_size, nIterations - first)
+        draws = rng.hypergeometric(cX+cY, nX+nY-cX-cY, nY, size=(n_block, cY.size))
+
+        null_cY.append( draws.sum(axis=1))
+
+    return np.concatenate(null_cY)
+
+
+def null_distribution(nX, nY, cX, cY):
+    """
+    Exact permutation distribution of the difference in accuracy between
+    two conditions (cooled - control), given the observed margins. For 
+    restricted permutations (counts given for each stratum), the count
+    of correct cooled trials is the convolution of each stratum's
+    hypergeometric distribution.
+
+    Parameters:
+    ----------
+    nX : int or array of int
+        Total number of trials in control condition (for each stratum)
+    nY : int or array of int
+        Total number of trials in cooled condition (for each stratum)
+    cX : int or array of int
+        Number of correct trials observed in control testing (for each stratum)
+    cY : int or array of int
+        Number of correct trials observed in cooled testing (for each stratum)
+
+    >>> null = null_distribution(2, 2, 1, 1)
+    >>> null['delta'].tolist(), null['pmf'].round(3).tolist()
+    ([-100.0, 0.0, 100.0], [0.167, 0.667, 0.167])
+
+    >>> null = null_distribution([1, 1], [1, 1], [1, 0], [0, 1])
+    >>> null['delta'].tolist(), null['pmf'].round(3).tolist()
+    ([-100.0, 0.0, 100.0], [0.25, 0.5, 0.25])
+
+    Returns:
+    --------
+    delta : numpy array
+        Each possible difference in percent correct (ascending)
+    pmf : numpy array
+        Probability of each difference under the null hypothesis
+    min_correct : int
+        Correct cooled trials for the first (most negative) difference
+    """
+
+    nX, nY, cX, cY = (np.atleast_1d(np.asarray(x, dtype=np.int64)) for x in (nX, nY, cX, cY))
+    nCorrect = cX + cY
+
+    pmf = np.ones(1)
+    min_correct = 0
+
+    for stratum_nX, stratum_nY, stratum_nCorrect in zip(nX, nY, nCorrect):
+        stratum_cY = np.arange(max(0, stratum_nCorrect - stratum_nX), min(stratum_nY, stratum_nCorrect) + 1)    # Possible correct trials among those labelled as cooled
+
+        pmf = np.convolve(pmf, hypergeom.pmf(stratum_cY, stratum_nX+stratum_nY, stratum_nCorrect, stratum_nY))
+        min_correct += stratum_cY[0]
+
+    null_cY = np.arange(pmf.size) + min_correct
+
+    return dict(
+        delta = (null_cY / nY.sum() - (nCorrect.sum() - null_cY) / nX.sum()) * 100,
+        pmf = pmf,
+        min_correct = min_correct
+    )
+
+
+def permute_within_strata(generator, values, n_permutations, strata=None):
+    """
+    Permute values many times at once, optionally only within strata
+    (restricted permutation). Rows are sorted by stratum once, so that 
+    each permutation is a single sort of random keys offset by stratum, 
+    without any per-stratum loop.
+
+    Parameters:
+    ----------
+    generator : numpy Generator
+        Random stream used for permutations
+    values : numpy array
+        Values to permute (one per trial)
+    n_permutations : int
+        Number of permutations to draw
+    strata : numpy array, optional
+        Integer code of the stratum of each trial (values are exchanged only 
+        between trials with equal codes)
+
+    >>> shuffled = permute_within_strata(np.random.default_rng(1), np.arange(6), 3, strata=np.array([0, 1, 0, 1, 0, 1]))
+    >>> bool(np.all(np.sort(shuffled[:, [0, 2, 4]], axis=1) == [0, 2, 4]))
+    True
+
+    Returns:
+    --------
+    shuffled : numpy array
+        Permuted values (n_permutations x trials)
+    """
+
+    if strata is None:
+        return generator.permuted(np.tile(values, (n_permutations, 1)), axis=1)
+
+    order = np.argsort(strata, kind='stable')
+    sorted_strata = strata[order]
+
+    # Sorting stratum + uniform keys keeps each stratum's block of positions, and shuffles within it
+    within_block = np.argsort(sorted_strata + generator.random((n_permutations, values.size)), axis=1)
+
+    shuffled = np.empty((n_permutations, values.size), dtype=values.dtype)
+    shuffled[:, order] = values[order][within_block]
+
+    return shuffled
+
+
+def shuffle_trial_vectors(nX, nY, cX, cY, nIterations, rng):
+    """
+    Shuffle condition labels of individual trials (legacy engine for 
+    permutation_test) and get the difference in proportion correct 
+    between conditions (cooled - control) on each iteration
+
+    Returns:
+    --------
+    shuffled_difference : numpy array
+        Differences in proportion correct (nIterations x 1)
+    """
 
     # Create vectors     
     isCooled = np.concatenate((np.zeros(nX), np.ones(nY)))
     isCorrect = np.concatenate((np.ones(cX), np.zeros(nX-cX), np.ones(cY), np.zeros(nY-cY)))
 
     # Randomly shuffle
-    rng = np.random.default_rng(seed=13)
     outcomes = np.zeros((nIterations, 2))
 
     for i in range(0, nIterations):
@@ -347,18 +898,364 @@ def permutation_test(nX, nY, cX, cY, nIterations=10000):
         outcomes[i,1] = isCorrect[isCooled==1].mean()
 
     # Get differences between conditions (cooled - control)
-    shuffled_difference = np.diff(outcomes, axis=1)     
-    observed_diff = (cY / nY) - (cX / nX)
+    return np.diff(outcomes, axis=1)     
+
+
+# NULL CACHE:
+@dataclass()
+class null_cache():
+    """ Null distributions of permutation tests, addressed by a hash of the margins and seed. Entries 
+    are kept in memory up to max_bytes (least recently used are evicted first) and, if cache_dir is 
+    given, on disk up to max_disk_bytes, so that they persist across reruns. """
+
+    max_bytes : int = 2**28
+    cache_dir : Optional[str] = None
+    max_disk_bytes : Optional[int] = None
+
+    def __post_init__(self):
+        self.cache_dir = Path(self.cache_dir) if self.cache_dir is not None else None
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    @staticmethod
+    def key(method: str, nX, nY, nCorrect, seed=None) -> Optional[str]:
+        """ Hash of the margins (for each stratum) and seed that determine a null distribution 
+        (None if the null is random and the seed can't reproduce it) """
+
+        if isinstance(seed, np.random.SeedSequence):
+            seed = [seed.entropy, list(seed.spawn_key), seed.pool_size]
+        elif isinstance(seed, (int, np.integer)):
+            seed = int(seed)
+        elif method != 'exact':
+            return None
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps([method, seed], default=str).encode())
+
+        for x in (nX, nY, nCorrect):
+            digest.update(np.asarray(x, dtype=np.int64).tobytes() + b'|')
+
+        return digest.hexdigest()
+
+
+    def get(self, key: str) -> Optional[dict]:
+        """ Stored null for key (or None if not yet computed) """
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        file_path = self.cache_dir / f"{key}.pkl" if self.cache_dir is not None else None
+
+        if file_path is not None and file_path.exists():
+            self.disk_hits += 1
+            os.utime(file_path)                                         # Mark as recently used
+            entry = pd.read_pickle(file_path)
+            self.remember(key, entry)
+            return entry
+
+        self.misses += 1
+        return None
+
+
+    def put(self, key: str, entry: dict) -> None:
+        """ Store null for key (replacing any shorter null drawn before) """
+
+        self.remember(key, entry)
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            pd.to_pickle(entry, self.cache_dir / f"{key}.pkl")
+            self.evict_from_disk()
+
+
+    def remember(self, key: str, entry: dict) -> None:
+        """ Keep entry in memory, evicting the least recently used entries beyond max_bytes """
+
+        if key in self.entries:
+            self.nbytes -= self.entry_bytes(self.entries.pop(key))
+
+        self.entries[key] = entry
+        self.nbytes += self.entry_bytes(entry)
+
+        while self.nbytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_bytes(evicted)
+            self.evictions += 1
+
+
+    def evict_from_disk(self) -> None:
+        """ Delete the least recently used files beyond max_disk_bytes """
+
+        if self.max_disk_bytes is None:
+            return
+
+        files = sorted(self.cache_dir.glob('*.pkl'), key=lambda x: x.stat().st_mtime)
+        disk_bytes = sum(x.stat().st_size for x in files)
+
+        while disk_bytes > self.max_disk_bytes and files:
+            file_path = files.pop(0)
+            disk_bytes -= file_path.stat().st_size
+            file_path.unlink()
+
 
-    p_below = np.sum(shuffled_difference < observed_diff) / nIterations         # Tail 1: Cooling impairs performance
-    p_above = np.sum(shuffled_difference > observed_diff) / nIterations         # Tail 2: Cooling improves performance  
+    @staticmethod
+    def entry_bytes(entry: dict) -> int:
+        """ Memory used by the arrays in an entry """
+
+        return sum(x.nbytes for x in entry.values() if isinstance(x, np.ndarray))
+
+
+    def stats(self) -> dict:
+        """ Number of hits (in memory and on disk) and misses in this session, and memory used """
+
+        n_lookups = self.hits + self.disk_hits + self.misses
+
+        return dict(
+            hits=self.hits, 
+            disk_hits=self.disk_hits, 
+            misses=self.misses, 
+            hit_rate=(self.hits + self.disk_hits) / n_lookups if n_lookups > 0 else np.nan,
+            n_entries=len(self.entries),
+            nbytes=self.nbytes,
+            evictions=self.evictions,
+            disk_bytes=sum(x.stat().st_size for x in self.cache_dir.glob('*.pkl')) if self.cache_dir is not None else 0
+        )
+
+
+# BATCH TESTS:
+def run_permutation_tests(jobs, n_jobs=None, seed=13, family=False, **test_options):
+    """
+    Run permutation tests for many jobs (e.g. every ferret and mask in a
+    paper) across a process pool, and collect results in one table
+
+    Each job is a dict with keys:
+        ferret : label for the subject (e.g. 'F1509')
+        data : dataframe of trials, with a Correct column
+        contrast : tuple of (column, control value, test value), e.g. ('treatment', False, True)
+        grouping : list of columns, optional - a separate test is run for each group (e.g. ['Mask'])
+        strata : list of columns, optional - restrict permutations within strata (e.g. ['day'])
+
+    Every test draws from its own stream, spawned from one seed sequence, 
+    so results don't depend on the number of workers or order of completion.
+
+    In family mode, the groups of each job are tested together on shared 
+    permutations (see run_family_job), adding p values corrected for the
+    number of groups (max-T).
     
-    return dict(
-        p_below = p_below, 
-        p_above = p_above, 
-        observed_delta = observed_diff * 100,                   # proportion to percentage
-        perm_values = shuffled_difference * 100                 # proportion to percentage
-    )
+    Parameters:
+    ----------
+    jobs : list of dict
+        Tests to run (see above)
+    n_jobs : int, optional
+        Number of worker processes (-1 for all cores; default runs in this process)
+    seed : int, optional
+        Entropy of the seed sequence from which test streams are spawned
+    family : bool, optional
+        Test all groups of each job on shared permutations, with family-wise p values
+    test_options : 
+        Arguments passed to permutation_test (e.g. method='exact', nIterations=10000), 
+        or run_family_job in family mode (e.g. nIterations=10000)
+
+    >>> df = pd.DataFrame(dict(treatment=[False]*20 + [True]*20, Mask=['Clean','Noise']*20, Correct=[1]*20 + [0]*20))
+    >>> results = run_permutation_tests([dict(ferret='F0', data=df, contrast=('treatment', False, True), grouping=['Mask'])], method='exact')
+    >>> results[['ferret','Mask','nX','nY','cX','cY','observed_delta']].to_dict('records')[0]
+    {'ferret': 'F0', 'Mask': 'Clean', 'nX': 10, 'nY': 10, 'cX': 10, 'cY': 0, 'observed_delta': -100.0}
+
+    >>> results = run_permutation_tests([dict(ferret='F0', data=df, contrast=('treatment', False, True), grouping=['Mask'])], family=True)
+    >>> results[['p_below','p_family']].to_dict('records')[0]
+    {'p_below': 0.0, 'p_family': 0.0}
+
+    Returns:
+    --------
+    results : pandas dataframe
+        One row per test, with the job and group labels, trial counts, observed delta, 
+        p values, iterations drawn and time taken (seconds)
+    """
+
+    seeds = np.random.SeedSequence(seed).spawn(len(jobs))
+    run_job = partial(run_family_job if family else run_permutation_job, **test_options)
+
+    if n_jobs is None or n_jobs == 1:
+        job_results = list(map(run_job, jobs, seeds))
+    else:
+        with ProcessPoolExecutor(max_workers=os.cpu_count() if n_jobs < 1 else n_jobs) as pool:
+            job_results = list(pool.map(run_job, jobs, seeds))
+
+    return pd.DataFrame(list(itertools.chain(*job_results)))
+
+
+def run_permutation_job(job, seed, **test_options):
+    """
+    Run the permutation test for each group of data in one job (see 
+    run_permutation_tests), with a stream spawned from seed for each group
+
+    Returns:
+    --------
+    results : list of dict
+        Labels, counts and test results for each group
+    """
+
+    column, control, test = job['contrast']
+    grouping = job.get('grouping', [])
+    strata = job.get('strata', [])
+
+    data = job['data']
+    data = data[data[column].isin([control, test])]
+    
+    groups = list(data.groupby(by=grouping)) if grouping else [((), data)]
+    results = []
+
+    for (keys, group), group_seed in zip(groups, seed.spawn(len(groups))):
+
+        start_time = time.perf_counter()
+
+        counts = group.groupby(by=strata + [column])['Correct'].agg(['count','sum']).unstack(column, fill_value=0)
+        nX, nY = counts['count'].get(control, 0), counts['count'].get(test, 0)
+        cX, cY = counts['sum'].get(control, 0), counts['sum'].get(test, 0)
+
+        if not strata:
+            nX, nY, cX, cY = (int(np.sum(x)) for x in (nX, nY, cX, cY))
+        else:
+            nX, nY, cX, cY = (np.asarray(x, dtype=np.int64) for x in (nX, nY, cX, cY))
+
+        pt = permutation_test(nX, nY, cX, cY, seed=group_seed, **test_options)
+
+        results.append( dict(
+            ferret = job['ferret'],
+            **dict(zip(grouping, keys)),
+            contrast = f"{column}: {test} - {control}",
+            strata = ', '.join(strata),
+            nX = int(np.sum(nX)), nY = int(np.sum(nY)), 
+            cX = int(np.sum(cX)), cY = int(np.sum(cY)),
+            observed_delta = pt['observed_delta'],
+            p_below = pt['p_below'],
+            p_above = pt['p_above'],
+            n_iterations = pt['n_iterations'],
+            seconds = time.perf_counter() - start_time
+        ))
+
+    return results
+
+
+def run_family_job(job, seed, nIterations=10000, max_draws=2**20):
+    """
+    Run permutation tests for all groups in one job (e.g. every mask for one
+    ferret) on one shared set of permutations, giving p values for each 
+    group and p values corrected for the family of groups by the max-T method
+    (Westfall & Young, 1993)
+
+    Labels are shuffled within groups (and strata), so on each iteration 
+    the correct trials labelled as test in every group and stratum are 
+    independent hypergeometric draws, all taken from the same permutation.
+    Groups are compared by the z statistic of the difference in proportions
+    (pooled over conditions, which is fixed by the margins), so that groups 
+    with different trial counts are on the same scale. The family-wise p value
+    of a group is the proportion of iterations in which the largest |z| of 
+    any group is at least as large as the observed |z| of that group.
+
+    Parameters:
+    ----------
+    job : dict
+        Test to run (see run_permutation_tests)
+    seed : numpy SeedSequence or int
+        Seed of the random stream
+    nIterations : int, optional
+        Number of permutations shared by all groups
+    max_draws : int, optional
+        Largest number of hypergeometric values drawn at once (limits memory)
+
+    Returns:
+    --------
+    results : list of dict
+        Labels, counts and test results for each group, including two-tailed (p_two_sided) 
+        and family-wise (p_family) p values
+    """
+
+    start_time = time.perf_counter()
+
+    column, control, test = job['contrast']
+    grouping = job.get('grouping', [])
+    strata = job.get('strata', [])
+
+    data = job['data']
+    data = data[data[column].isin([control, test])]
+
+    if grouping or strata:
+        counts = data.groupby(by=grouping + strata + [column])['Correct'].agg(['count','sum']).unstack(column, fill_value=0)
+    else:
+        counts = data.groupby(by=column)['Correct'].agg(['count','sum']).unstack().to_frame().T           # One cell for the whole job
+
+    if grouping:
+        group_codes, group_keys = pd.factorize(counts.index.droplevel(strata) if strata else counts.index)      # Cells are sorted by group
+    else:
+        group_codes, group_keys = np.zeros(len(counts), dtype=np.int64), [()]
+
+    # Trials in each cell (group or group x stratum)
+    cell_nX, cell_nY = (counts['count'].get(x, pd.Series(0, index=counts.index)).to_numpy(dtype=np.int64) for x in (control, test))
+    cell_cX, cell_cY = (counts['sum'].get(x, pd.Series(0, index=counts.index)).to_numpy(dtype=np.int64) for x in (control, test))
+
+    group_starts = np.flatnonzero(np.diff(group_codes, prepend=-1))
+    nX, nY, cX, cY = (np.add.reduceat(x, group_starts) for x in (cell_nX, cell_nY, cell_cX, cell_cY))
+
+    # Correct test trials in each group, on each shared permutation
+    rng = np.random.default_rng(seed)
+    block_size = max(1, max_draws // cell_cY.size)
+    null_cY = []
+
+    for first in range(0, nIterations, block_size):
+        n_block = min(block_size, nIterations - first)
+        draws = rng.hypergeometric(cell_cX+cell_cY, cell_nX+cell_nY-cell_cX-cell_cY, cell_nY, size=(n_block, cell_cY.size))
+
+        null_cY.append( np.add.reduceat(draws, group_starts, axis=1))
+
+    null_cY = np.concatenate(null_cY)
+
+    observed_z = pooled_z(nX, nY, cX, cY)
+    null_z = pooled_z(nX, nY, cX+cY-null_cY, null_cY)
+    
+    max_z = np.max(np.abs(null_z), axis=1)
+    tolerance = 1e-9                                                    # Statistics equal to observation may differ in rounding error
+    
+    results = []
+    for i, keys in enumerate(group_keys):
+
+        keys = keys if isinstance(keys, tuple) else (keys,)
+
+        results.append( dict(
+            ferret = job['ferret'],
+            **dict(zip(grouping, keys)),
+            contrast = f"{column}: {test} - {control}",
+            strata = ', '.join(strata),
+            nX = int(nX[i]), nY = int(nY[i]), 
+            cX = int(cX[i]), cY = int(cY[i]),
+            observed_delta = (cY[i] / nY[i] - cX[i] / nX[i]) * 100,
+            z = observed_z[i],
+            p_below = np.sum(null_cY[:, i] < cY[i]) / nIterations,                                   # Tail 1: Test impairs performance
+            p_above = np.sum(null_cY[:, i] > cY[i]) / nIterations,                                   # Tail 2: Test improves performance
+            p_two_sided = np.sum(np.abs(null_z[:, i]) >= abs(observed_z[i]) - tolerance) / nIterations,
+            p_family = np.sum(max_z >= abs(observed_z[i]) - tolerance) / nIterations,               # Corrected for all groups in job
+            n_iterations = nIterations,
+            seconds = time.perf_counter() - start_time
+        ))
+
+    return results
+
+
+def pooled_z(nX, nY, cX, cY):
+    """ z statistic for the difference in proportion correct (y - x), using the proportion pooled over conditions (0 if all trials were correct or incorrect) """
+
+    pooled = (cX + cY) / (nX + nY)
+    se = np.sqrt(pooled * (1 - pooled) * (1 / nX + 1 / nY))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(se > 0, (cY / nY - cX / nX) / np.where(se > 0, se, 1), 0.0)
 
 
 def round_to_nearest(ser, round_to):
@@ -0,0 +1,119 @@
+"""
+Import of session files saved by GoFerret during experiments (tab-separated text, one file per session)
+
+Files are parsed concurrently and common formatting issues are fixed for each file. Parsed files
+can be cached in binary format, addressed by file path, modification time and size, so that
+rebuilding a summary after adding a session only parses the new file.
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from Results.cooling_analysis import filename_to_sessiondate
+
+
+column_corrections = {                      # Early column headers included "?"
+    'CorrectionTrial?': 'CorrectionTrial',
+    'CenterReward?': 'CenterReward'
+}
+
+
+def read_session_files(files, cache_dir: Optional[str] = None, n_jobs: Optional[int] = None, use_processes: bool = False,
+    session_date: Optional[str] = None, index_col: Optional[str] = None) -> list:
+    """
+    Read many session files concurrently (see read_session_file)
+
+    Parameters:
+    ----------
+    files : iterable of Path
+        Session files (e.g. from Path.glob('*.txt'))
+    cache_dir : str, optional
+        Directory in which parsed files are cached
+    n_jobs : int, optional
+        Number of workers (-1 or None for one per core, 1 to read in this thread)
+    use_processes : bool, optional
+        Read files in a process pool (rather than threads)
+    session_date : str, optional
+        Name of column to add with the session start time (from the file name)
+    index_col : str, optional
+        Column to use as index (e.g. 'Trial')
+
+    Returns:
+    --------
+    data : list of pandas dataframes
+        Data from each file, in the same order as files
+    """
+
+    files = list(files)
+    read_file = partial(read_session_file, cache_dir=cache_dir, session_date=session_date, index_col=index_col)
+
+    if n_jobs == 1:
+        return list(map(read_file, files))
+
+    max_workers = None if n_jobs is None or n_jobs < 1 else n_jobs
+    Executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+
+    with Executor(max_workers=max_workers) as pool:
+        return list(pool.map(read_file, files))
+
+
+def read_session_file(file_path: Path, cache_dir: Optional[str] = None, session_date: Optional[str] = None, index_col: Optional[str] = None) -> pd.DataFrame:
+    """
+    Read one session file, removing unnamed columns (formatting of source data creates an unnamed
+    column at the end of the table) and correcting early column headers that included "?"
+
+    Parameters:
+    ----------
+    file_path : Path
+        Session file, named in GoFerret format (e.g. '08_07_2014 level23_spatial_Magnum 17_56 log.txt')
+    cache_dir : str, optional
+        Directory in which the parsed file is cached
+    session_date : str, optional
+        Name of column to add with the session start time (from the file name)
+    index_col : str, optional
+        Column to use as index (e.g. 'Trial')
+
+    Returns:
+    --------
+    df : pandas dataframe
+        Data from file
+    """
+
+    file_path = Path(file_path)
+    cache_path = Path(cache_dir) / f"{cache_key(file_path, index_col=index_col)}.pkl" if cache_dir is not None else None
+
+    if cache_path is not None and cache_path.exists():
+        df = pd.read_pickle(cache_path)
+    else:
+        df = pd.read_csv(file_path, sep='\t', encoding='latin1', index_col=index_col)
+
+        df = df.drop(columns=[x for x in df.columns if 'Unnamed' in x])
+        df = df.rename(columns=column_corrections)
+
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            pd.to_pickle(df, cache_path)
+
+    if session_date is not None:
+        df[session_date] = filename_to_sessiondate(file_path.stem)
+
+    return df
+
+
+def cache_key(file_path: Path, **options) -> str:
+    """ Hash of file path, modification time and size, and options used to parse the file """
+
+    stats = os.stat(file_path)
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(file_path.resolve()), stats.st_mtime_ns, stats.st_size, column_corrections, options], sort_keys=True).encode())
+
+    return digest.hexdigest()
@@ -2,14 +2,20 @@
 Classes for managing, resampling and summarizing data using pandas dataframes
 
 """
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import partial
+import hashlib
 import itertools
+import json
+import os
 from pathlib import Path
 from typing import Optional
 
 import numpy as np
 from numpy.random import PCG64
 import pandas as pd
+from scipy.stats import norm
 
 
 @dataclass
@@ -42,22 +48,96 @@ class ferret():
         self.overSessions = count_correct_trials(self.data, plot_columns)
                    
 
-    def bootstrap(self, plot_vars: list, flat_vars: list, nBoots: int = 0) -> None:
-        """Get proportion of trials correct in each clean and noise conditions, with and without cooling"""
+    def bootstrap(self, plot_vars: Optional[list] = None, flat_vars: Optional[list] = None, nBoots: int = 0, engine: str = 'pandas', n_jobs: Optional[int] = None, 
+        chunk_size: int = 100, streaming: bool = False, spill_path: Optional[str] = None, cache = None, checkpoint_dir: Optional[str] = None, 
+        tolerance: Optional[float] = None, specs: Optional[dict] = None, keep_samples: str = 'last') -> None:
+        """Get proportion of trials correct in each clean and noise conditions, with and without cooling
+        
+        If a result_cache is given (and nothing is spilled to disk), results are reused whenever the data, 
+        parameters and random state match a previous run. If checkpoint_dir is given, chunks of iterations 
+        are saved as they complete, so that an interrupted run can be resumed, or a run extended to more 
+        iterations, without repeating work. If tolerance is given, iterations stop once the Monte Carlo error 
+        of each condition's mean and confidence interval is below tolerance (% correct), with nBoots as a cap.
+
+        Several analyses can be run in one pass by giving specs (name: (plot_vars, flat_vars)) instead of 
+        plot_vars and flat_vars. Specifications that flatten the same cells (e.g. BY_SNR and OVER_SNR) share 
+        one set of resamples, and results, summaries and sample data are then dictionaries keyed by name.
+
+        Row indices of flattened samples (into the analysis file) are kept in sample_rows, for the last 
+        iteration or, with keep_samples='all', for every iteration (iterations x trials).
+        """
+
+        options = dict(nBoots=nBoots, engine=engine, n_jobs=n_jobs, chunk_size=chunk_size, streaming=streaming, 
+            spill_path=spill_path, cache=cache, checkpoint_dir=checkpoint_dir, tolerance=tolerance, keep_samples=keep_samples)
+
+        if specs is None:
+            results, summaries, self.sample_data, self.sample_rows, self.n_iterations = self.resample(plot_vars, flat_vars, [], **options)
+            self.results, self.summary = results[0], summaries[0]
+            return
+
+        self.results, self.summary, self.sample_data, self.sample_rows, self.n_iterations = {}, {}, {}, {}, {}
+
+        for names in group_specs(self.data, specs):
+            plot_vars, flat_vars = specs[names[0]]
+            results, summaries, sample_data, sample_rows, n_iterations = self.resample(plot_vars, flat_vars, [specs[x][0] for x in names[1:]], **options)
+
+            for name, result, summary in zip(names, results, summaries):
+                self.results[name], self.summary[name] = result, summary
+                self.sample_data[name], self.sample_rows[name], self.n_iterations[name] = sample_data, sample_rows, n_iterations
+
+
+    def resample(self, plot_vars: list, flat_vars: list, extra_plot_vars: list, nBoots: int, engine: str, n_jobs: Optional[int], chunk_size: int, 
+        streaming: bool, spill_path: Optional[str], cache, checkpoint_dir: Optional[str], tolerance: Optional[float], keep_samples: str) -> tuple:
+        """ Run (or load from cache) one bootstrap, summarized for plot_vars and any extra plot variables 
+        
+        Returns lists of results and summaries (one per set of plot variables), sample data, sample row indices and the number of iterations
+        """
+
+        chunked = n_jobs is not None or streaming or checkpoint_dir is not None or tolerance is not None
+
+        if cache is not None and spill_path is None:
+            key = cache.key(self.data, 
+                plot_vars=plot_vars, flat_vars=flat_vars, extra_plot_vars=extra_plot_vars, nBoots=nBoots, engine=engine, streaming=streaming, tolerance=tolerance, keep_samples=keep_samples,
+                chunk_size=chunk_size if chunked else None,                                           # Worker count doesn't affect results
+                rng_state=self.rng.state)
+
+            entry = cache.get(key)
+
+            if entry is not None:
+                self.rng.state = entry['rng_state']                                                  # Leave stream where a fresh run would have
+                return entry['results'], entry['summaries'], entry['sample_data'], entry['sample_rows'], entry['n_iterations']
 
-        summary = summary_table(self.data, plot_vars, flat_vars, self.rng, nBoots)
+        summary = summary_table(self.data, plot_vars, flat_vars, self.rng, nBoots, engine, n_jobs, chunk_size, streaming, spill_path, 
+            checkpoint_dir=checkpoint_dir, tolerance=tolerance, extra_plot_columns=extra_plot_vars, keep_samples=keep_samples)
         summary.count_correct_trials()
         summary.post_processing()
 
-        self.results = summary.bootstrap_data
-        self.sample_data = summary.flattened_sample
+        results = summary.spec_data                     # None when streaming (see spill_path for every iteration)
+        summaries = summary.spec_tables
 
+        if cache is not None and spill_path is None:
+            cache.put(key, dict(results=results, summaries=summaries, sample_data=summary.flattened_sample, sample_rows=summary.sample_rows, 
+                n_iterations=summary.n_iterations, rng_state=self.rng.state))
 
-    def write_results(self, file_path: str, file_suffix: str) -> None:
-        """ Write csv files containing bootstrap results and seample data"""
+        return results, summaries, summary.flattened_sample, summary.sample_rows, summary.n_iterations
 
-        self.results.to_csv(Path(file_path) / f"{self.fstr}_{file_suffix}.csv", index=False)
-        self.sample_data.to_csv(Path(file_path) / f"{self.fstr}_{file_suffix}_SAMPLE.csv", index=False)
+
+    def write_results(self, file_path: str, file_suffix: Optional[str] = None, file_format: str = 'csv', sample_format: str = 'table') -> None:
+        """ Write files (csv, parquet or feather) containing bootstrap results (or summary if streamed) and seample data
+        
+        Results from several specifications are each written with their name as the file suffix (a single result is 
+        written without a suffix if none is given). Samples are written either as a table of flattened data ('table'), 
+        or as row indices into the analysis file ('index'; see sample_index)
+        """
+
+        if isinstance(self.summary, dict):
+            for name in self.summary:
+                samples = self.sample_data[name] if sample_format == 'table' else self.sample_rows[name]
+                write_results(Path(file_path) / f"{self.fstr}_{name}", self.results[name], self.summary[name], samples, file_format)
+        else:
+            samples = self.sample_data if sample_format == 'table' else self.sample_rows
+            file_stem = self.fstr if file_suffix is None else f"{self.fstr}_{file_suffix}"
+            write_results(Path(file_path) / file_stem, self.results, self.summary, samples, file_format)
 
 
 
@@ -71,66 +151,445 @@ class summary_table():
     flat_columns : list
     rng : PCG64
     nBootstrap : int = 0
+    engine : str = 'pandas'             # 'pandas' (resample with DataFrame.sample) or 'vectorized' (index arrays)
+    n_jobs : Optional[int] = None       # Resample in chunks across worker processes (vectorized engine; -1 for all cores)
+    chunk_size : int = 100              # Iterations per chunk when n_jobs is set (or streaming)
+    streaming : bool = False            # Keep running summaries instead of every iteration (vectorized engine)
+    spill_path : Optional[str] = None   # Csv file to which every iteration is appended when streaming
+    ci : float = 95.0                   # Confidence interval (%) reported by streaming summaries
+    checkpoint_dir : Optional[str] = None   # Save each chunk here so that runs can be resumed or extended (vectorized engine)
+    tolerance : Optional[float] = None      # Stop once Monte Carlo error (% correct) is below this value, with nBootstrap as a cap
+    extra_plot_columns : Optional[list] = None      # Further sets of plot columns summarized from the same resamples (see group_specs)
+    keep_samples : str = 'last'         # Keep row indices of the flattened sample drawn on the 'last' iteration, or on 'all' iterations
 
     def __post_init__(self):
-        """ Get lowest number of trials that a given attenuation has for all combinations of conditions """
+        """ Factorize combinations of plot and flat columns (cells) into integer codes, and get the 
+        median number of trials that cells have, which is the number drawn from each when flattening """
+
+        self.cell_codes, self.cell_labels = factorize_cells(self.data, self.plot_columns + self.flat_columns)
+        n_cells = self.cell_labels.shape[0]
                 
-        isOk, n_trials = self.check_all_permutations_tested(self.data, self.plot_columns + self.flat_columns)
+        isOk, n_trials = self.check_all_permutations_tested(self.data, self.plot_columns + self.flat_columns, self.cell_codes)
 
         if not isOk:
             print('Permutation warning')
             
-        self.median_trials = n_trials.median()
+        self.median_trials = np.median(n_trials)
         self.median_trials = int(np.floor(self.median_trials))
 
+        self.spec_columns = [self.plot_columns] + list(self.extra_plot_columns or [])
+
+        # Row positions sorted by cell (rows with missing keys have code -1 and are not resampled)
+        self.correct = self.data['Correct'].to_numpy()
+        self.cell_rows = np.argsort(self.cell_codes, kind='stable')[np.sum(self.cell_codes < 0):]
+        self.cell_offsets = np.concatenate(([0], np.cumsum(np.bincount(self.cell_codes[self.cell_codes >= 0], minlength=n_cells))))
+
 
     @staticmethod
-    def check_all_permutations_tested(df: pd.DataFrame, columns: list) -> bool:
+    def check_all_permutations_tested(df: pd.DataFrame, columns: list, cell_codes: Optional[np.ndarray] = None) -> bool:
         # Does data exist for all possible combinations of values within columns
 
         n_conditions = [len(df[c].unique()) for c in columns]
         n_permutations = np.prod(n_conditions)
 
-        n_trials = df.groupby(by=columns).size()
+        if cell_codes is None:
+            cell_codes, _ = factorize_cells(df, columns)
+
+        n_trials = np.bincount(cell_codes[cell_codes >= 0])
         
-        return n_trials.shape[0] == n_permutations, n_trials
+        return n_trials.size == n_permutations, n_trials
 
 
-    def flatten(self) -> pd.DataFrame:
-        """ Subsample equal numbers of trials (flatten) for all combinations of columns of interest """
+    def flatten_rows(self) -> np.ndarray:
+        """ Row positions of equal numbers of trials subsampled from every cell (in cell order) """
 
-        flat_data = []
-        for conditions, uneven_data in self.data.groupby(by=self.plot_columns+self.flat_columns):           
+        return np.concatenate([
+            pd.Series(self.cell_rows[start:stop]).sample(n = self.median_trials, random_state=self.rng, replace=True).to_numpy()
+            for start, stop in zip(self.cell_offsets[:-1], self.cell_offsets[1:])
+            ])
 
-            flat_data.append( uneven_data.sample(n = self.median_trials, random_state=self.rng, replace=True))
 
-        return pd.concat(flat_data)
+    def flatten(self) -> pd.DataFrame:
+        """ Subsample equal numbers of trials (flatten) for all combinations of columns of interest """
+
+        return self.data.iloc[self.flatten_rows()]
 
     
-    def bootstrap_resample(self) -> pd.DataFrame:
-        """ Count correct trials for many instances of flattened data """
-        bootstrap_results = []
+    def bootstrap_resample(self) -> tuple:
+        """ Count correct trials for many instances of flattened data (for each set of plot columns) 
+        
+        Rows are drawn cell by cell with DataFrame.sample's random stream, so results are the same as 
+        grouping the data and sampling each group.
+        """
+
+        self.index_cells()
+        nCorrect = np.zeros((self.nBootstrap, self.plot_nTrials.size), dtype=self.correct.dtype)
+        samples = []
 
         for i in range(0, self.nBootstrap):
 
-            flat_data = self.flatten()        # Resample data each iteration
+            flat_rows = self.flatten_rows()        # Resample data each iteration
 
-            flat_results_i = count_correct_trials(flat_data, self.plot_columns)
-            flat_results_i['iteration'] = i
+            if self.keep_samples == 'all':
+                samples.append(flat_rows)
 
-            bootstrap_results.append( flat_results_i)
+            cell_nCorrect = self.correct[flat_rows].reshape(-1, self.median_trials).sum(axis=1)
+            nCorrect[i] = np.add.reduceat(cell_nCorrect[self.cell_order], self.plot_starts)
             
             if i % 100 == 0:                    # Report progress
                 print(f"\t\tIteration {i} of {self.nBootstrap}")
 
-        return pd.concat(bootstrap_results), flat_data
+        return [self.to_long_format(nCorrect, spec=k) for k in range(len(self.spec_columns))], np.stack(samples) if samples else flat_rows
+
+
+    def is_chunked(self) -> bool:
+        """ Whether iterations are drawn in chunks with their own random streams (rather than one stream for all) """
+        return self.n_jobs is not None or self.streaming or self.checkpoint_dir is not None or self.tolerance is not None
+
+
+    def index_cells(self) -> None:
+        """ Order cells for each set of plot columns, so that each plot condition covers a contiguous run of cells 
+        
+        Cells are already sorted with the main plot columns first. Cells for the conditions of all sets are then 
+        laid end to end, with plot_starts indexing the first cell of each condition.
+        """
+
+        # Extra plot columns that are derived from cell columns are read off the first row of each cell
+        cell_labels = self.cell_labels.copy()
+        first_rows = self.data.iloc[self.cell_rows[self.cell_offsets[:-1]]]
+
+        for column in itertools.chain(*self.spec_columns):
+            if column not in cell_labels:
+                cell_labels[column] = first_rows[column].to_numpy()
+
+        self.spec_labels, cell_order, plot_starts, plot_nCells = [], [], [], []
+        n_ordered = 0
+
+        for plot_columns in self.spec_columns:
+            plot_codes, labels = factorize_cells(cell_labels, plot_columns)
+            order = np.argsort(plot_codes, kind='stable')[np.sum(plot_codes < 0):]
+
+            self.spec_labels.append(labels)
+            cell_order.append(order)
+            plot_starts.append( np.flatnonzero(np.diff(plot_codes[order], prepend=-1)) + n_ordered)
+            plot_nCells.append( np.bincount(plot_codes[order], minlength=labels.shape[0]))
+            n_ordered += order.size
+
+        self.plot_labels = self.spec_labels[0]
+        self.cell_order = np.concatenate(cell_order)
+        self.plot_starts = np.concatenate(plot_starts)
+        self.plot_nTrials = np.concatenate(plot_nCells) * self.median_trials
+        self.spec_bounds = np.cumsum([0] + [x.shape[0] for x in self.spec_labels])        # Columns of correct counts belonging to each set
+
+
+    def count_cells(self) -> list:
+        """ Count all trials (without resampling) for each set of plot columns """
+
+        self.index_cells()
+
+        cell_nTrials = np.diff(self.cell_offsets)
+        cell_nCorrect = np.add.reduceat(self.correct[self.cell_rows], self.cell_offsets[:-1])
+
+        nTrials = np.add.reduceat(cell_nTrials[self.cell_order], self.plot_starts)
+        nCorrect = np.add.reduceat(cell_nCorrect[self.cell_order], self.plot_starts)
+
+        tables = []
+        for labels, start, stop in zip(self.spec_labels, self.spec_bounds[:-1], self.spec_bounds[1:]):
+            results = labels.copy()
+            results['nTrials'] = nTrials[start:stop]
+            results['nCorrect'] = nCorrect[start:stop]
+            results['pCorrect'] = results['nCorrect'] / results['nTrials'] * 100
+            tables.append(results)
+
+        return tables
+
+
+    def bootstrap_resample_vectorized(self) -> pd.DataFrame:
+        """ Count correct trials for many instances of flattened data, drawing every iteration at once 
+        
+        Each flattening cell is resampled with a single (nBootstrap x median_trials) array of row 
+        indices, and correct trials are then summed over cells that share plot conditions. Uses a 
+        different random stream to the pandas engine.
+        """
+
+        self.index_cells()
+
+        if not self.is_chunked():
+            print(f"\t\tDrawing {self.nBootstrap} iterations")
+            nCorrect, sample = resample_cells(np.random.Generator(self.rng), self.nBootstrap, self.correct, self.cell_rows, self.cell_offsets, 
+                self.plot_starts, self.median_trials, sample_iteration=self.sample_iteration(), cell_order=self.cell_order)
+        else:
+            nCorrect, sample = self.resample_chunks()
+
+        return [self.to_long_format(nCorrect, spec=k) for k in range(len(self.spec_columns))], sample
+
+
+    def sample_iteration(self, n_iterations: Optional[int] = None):
+        """ Iterations of a batch for which drawn rows are kept (the last of the run, or all) """
+
+        if self.keep_samples == 'all':
+            return slice(None)
+
+        return -1 if n_iterations is None else (self.nBootstrap-1) % n_iterations
+
+
+    def iter_chunks(self):
+        """ Resample fixed-size chunks of iterations, in order, optionally across a process pool 
+        
+        Chunk k always draws chunk_size iterations from the stream rng.jumped(k+1), so results
+        depend on the starting state of rng and chunk_size, but not on the number of workers.
+        The first N iterations of any run are therefore the same as a run of N iterations, which
+        allows chunks saved in checkpoint_dir to be reused when resuming or extending a run.
+
+        Yields the first iteration of each chunk, its correct counts and the sample drawn on
+        the final iteration (None for chunks loaded from a checkpoint), or on every iteration
+        if all samples are kept.
+        """
+
+        n_chunks = int(np.ceil(self.nBootstrap / self.chunk_size))
+        streams = [np.random.Generator(self.rng.jumped(k+1)) for k in range(n_chunks)]
+
+        # The final chunk is always drawn, as its sample is returned with the results
+        saved_chunks = self.read_checkpoint()
+        self.n_checkpointed = len(saved_chunks)
+
+        saved_chunks = saved_chunks[:n_chunks-1]
+        n_saved = len(saved_chunks)
+
+        count_chunk = self.chunk_resampler()
+
+        print(f"\t\tDrawing {self.nBootstrap} iterations in {n_chunks} chunks ({n_saved} from checkpoint)")
+
+        if self.n_jobs is None or self.n_jobs == 1:
+            pool = None
+            chunks = map(count_chunk, streams[n_saved:])
+        else:
+            pool = ProcessPoolExecutor(max_workers=os.cpu_count() if self.n_jobs < 1 else self.n_jobs)
+            chunks = pool.map(count_chunk, streams[n_saved:])
+
+        try:
+            for k, (nCorrect, sample) in enumerate(itertools.chain(saved_chunks, chunks)):
+
+                if k >= n_saved:
+                    self.write_checkpoint(k, nCorrect, sample)
+
+                first_iteration = k * self.chunk_size
+                n_kept = self.nBootstrap - first_iteration                  # Drop iterations drawn beyond nBootstrap in the final chunk
+
+                yield first_iteration, nCorrect[:n_kept], sample if sample is None or sample.ndim == 1 else sample[:n_kept]
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        self.rng.state = self.rng.jumped(n_chunks+1).state           # Move past the chunk streams (so later tables don't reuse them)
+
+
+    def chunk_resampler(self) -> partial:
+        """ Resample one chunk of iterations from a given random stream """
+
+        return partial(resample_cells, 
+            n_iterations=self.chunk_size, correct=self.correct, cell_rows=self.cell_rows, 
+            cell_offsets=self.cell_offsets, plot_starts=self.plot_starts, n_samples=self.median_trials, 
+            sample_iteration=self.sample_iteration(self.chunk_size), cell_order=self.cell_order)
 
 
-    def summarize_bootstrap(self, bootstrap_results: pd.DataFrame) -> pd.DataFrame:
+    def checkpoint_key(self) -> str:
+        """ Identify the data, conditions, chunking and starting random state behind saved chunks """
+
+        return result_cache.key(self.data, plot_columns=self.plot_columns, flat_columns=self.flat_columns, 
+            extra_plot_columns=self.spec_columns[1:], chunk_size=self.chunk_size, rng_state=self.rng.state)
+
+
+    def read_checkpoint(self) -> list:
+        """ Load correct counts (and row indices, if all samples are kept) for consecutive chunks completed by a 
+        previous (interrupted or shorter) run 
+        
+        Each run is saved in its own subdirectory of checkpoint_dir (named by the start of its checkpoint key), 
+        so that runs for several subjects or sets of conditions can share one checkpoint_dir.
+
+        >>> import contextlib, io, tempfile
+        >>> df = pd.DataFrame(dict(Mask=['Clean','Noise']*50, vowel=list('aabb')*25, Correct=np.random.default_rng(0).integers(0, 2, 100)))
+        >>> checkpoint_dir = tempfile.mkdtemp()
+        >>> def run(plot_columns, flat_columns):
+        ...     table = summary_table(df, plot_columns, flat_columns, PCG64(1), nBootstrap=300, engine='vectorized', checkpoint_dir=checkpoint_dir)
+        ...     with contextlib.redirect_stdout(io.StringIO()):
+        ...         table.count_correct_trials()
+        ...     return table.n_checkpointed
+        >>> [run(['Mask'], ['vowel']), run(['vowel'], ['Mask'])]           # First pass draws every chunk...
+        [3, 3]
+        >>> tables = [summary_table(df, ['Mask'], ['vowel'], PCG64(1), checkpoint_dir=checkpoint_dir), summary_table(df, ['vowel'], ['Mask'], PCG64(1), checkpoint_dir=checkpoint_dir)]
+        >>> [len(x.read_checkpoint()) for x in tables]                      # ...and the second resumes both
+        [3, 3]
+        """
+
+        if self.checkpoint_dir is None:
+            return []
+
+        self.run_key = self.checkpoint_key()
+        self.run_dir = Path(self.checkpoint_dir) / self.run_key[:16]
+        state_file = self.run_dir / 'checkpoint.json'
+
+        if not state_file.exists():
+            return []
+
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+
+        if state['key'] != self.run_key:
+            print(f"\t\tCheckpoint in {self.run_dir} is for a different run - starting again")
+            return []
+
+        saved_chunks = []
+
+        for k in range(state['completed_chunks']):
+            rows_file = self.run_dir / f"chunk_{k:06d}_rows.npy"
+
+            if self.keep_samples != 'all':
+                saved_chunks.append( (np.load(self.run_dir / f"chunk_{k:06d}.npy"), None))
+            elif rows_file.exists():
+                saved_chunks.append( (np.load(self.run_dir / f"chunk_{k:06d}.npy"), np.load(rows_file)))
+            else:
+                break                                                       # Chunks saved without their samples are drawn again
+
+        return saved_chunks
+
+
+    def write_checkpoint(self, k: int, nCorrect: np.ndarray, sample: np.ndarray) -> None:
+        """ Save correct counts for chunk k (all chunk_size iterations), with row indices if all samples are kept, 
+        and record progress with the random state (in the run directory set by read_checkpoint) """
+
+        if self.checkpoint_dir is None:
+            return
+
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+
+        np.save(self.run_dir / f"chunk_{k:06d}.npy", nCorrect)
+
+        if sample.ndim == 2:
+            np.save(self.run_dir / f"chunk_{k:06d}_rows.npy", sample.astype(np.uint32))
+        self.n_checkpointed = max(self.n_checkpointed, k + 1)                # Keep chunks from longer runs
+
+        with open(self.run_dir / 'checkpoint.json', 'w') as f:
+            json.dump(dict(
+                key = self.run_key,
+                rng_state = self.rng.state,                         # Starting state (chunk streams are jumped from here)
+                chunk_size = self.chunk_size,
+                completed_chunks = self.n_checkpointed,
+                completed_iterations = self.n_checkpointed * self.chunk_size
+                ), f, indent=2)
+
+
+    def draw_chunks(self):
+        """ Chunks of iterations, stopping early in adaptive mode (tolerance is set) once the Monte Carlo 
+        standard errors of the mean and confidence interval endpoints are below tolerance for every plot 
+        condition. nBootstrap then acts as a cap, and the number of iterations used is kept in n_iterations.
+
+        Rerunning against a checkpoint stops on the same chunk, with the same sample:
+
+        >>> import contextlib, io, tempfile
+        >>> df = pd.DataFrame(dict(Mask=['Clean','Noise']*200, vowel=list('aabb')*100, Correct=np.random.default_rng(0).integers(0, 2, 400)))
+        >>> checkpoint_dir = tempfile.mkdtemp()
+        >>> runs = [summary_table(df, ['Mask'], ['vowel'], PCG64(1), nBootstrap=5000, engine='vectorized', checkpoint_dir=checkpoint_dir, tolerance=0.5) for _ in range(2)]
+        >>> with contextlib.redirect_stdout(io.StringIO()):
+        ...     for x in runs: x.count_correct_trials()
+        >>> runs[0].n_iterations == runs[1].n_iterations < 5000, runs[0].table.equals(runs[1].table), runs[0].flattened_sample.equals(runs[1].flattened_sample)
+        (True, True, True)
+        """
+
+        if self.tolerance is None:
+            yield from self.iter_chunks()
+            self.n_iterations = self.nBootstrap
+            return
+
+        accumulator = bootstrap_accumulator(self.plot_nTrials)
+        chunks = self.iter_chunks()
+
+        for first_iteration, nCorrect, sample in chunks:
+
+            accumulator.update(nCorrect)
+            is_converged = np.all(accumulator.monte_carlo_error(self.ci) < self.tolerance)
+
+            if is_converged and sample is None:                         # Chunk loaded from checkpoint, so draw it again for its sample
+                stream = np.random.Generator(self.rng.jumped(first_iteration // self.chunk_size + 1))
+                _, sample = self.chunk_resampler()(stream)
+
+            yield first_iteration, nCorrect, sample
+
+            if is_converged:
+                chunks.close()                                          # Cancels chunks queued in the process pool
+                self.rng.state = self.rng.jumped(accumulator.n // self.chunk_size + 1).state   # As for a run of this length
+                break
+
+        self.n_iterations = accumulator.n
+        print(f"\t\tUsed {self.n_iterations} of {self.nBootstrap} iterations (max. Monte Carlo error = {accumulator.monte_carlo_error(self.ci).max():.3f}%)")
+
+
+    def resample_chunks(self) -> tuple:
+        """ Collect correct counts from all chunks of iterations """
+
+        chunks = list(self.draw_chunks())
+        nCorrect = np.concatenate([c[1] for c in chunks])
+
+        if self.keep_samples == 'all':
+            return nCorrect, np.concatenate([c[2] for c in chunks])
+
+        return nCorrect, chunks[-1][2]
+
+
+    def bootstrap_stream(self) -> tuple:
+        """ Fold chunks of iterations into running summaries, so memory scales with conditions rather than iterations 
+        
+        Every iteration can optionally be appended to a csv file (spill_path) in the same long format as bootstrap_data
+        (only for a single set of plot columns).
+        """
+
+        self.index_cells()
+        accumulator = bootstrap_accumulator(self.plot_nTrials)
+
+        if self.spill_path is not None and len(self.spec_columns) > 1:
+            raise ValueError('Spilling iterations to disk requires a single set of plot columns')
+
+        if self.spill_path is not None:
+            Path(self.spill_path).unlink(missing_ok=True)
+
+        for first_iteration, nCorrect, sample in self.draw_chunks():
+
+            accumulator.update(nCorrect)
+
+            if self.spill_path is not None:
+                self.to_long_format(nCorrect, first_iteration).to_csv(self.spill_path, mode='a', header=(first_iteration == 0), index=False)
+
+        table = accumulator.summarize(pd.concat(self.spec_labels, ignore_index=True), self.ci)[['mean','std','ci_lower','ci_upper']]
+        spec_tables = [pd.concat([labels, table.iloc[a:b].reset_index(drop=True)], axis=1) 
+            for labels, a, b in zip(self.spec_labels, self.spec_bounds[:-1], self.spec_bounds[1:])]
+
+        return spec_tables, sample
+
+
+    def to_long_format(self, nCorrect: np.ndarray, first_iteration: int = 0, spec: int = 0) -> pd.DataFrame:
+        """ Arrange an (iterations x plot conditions) array of correct counts as one row per condition per iteration, 
+        for one set of plot columns (spec) """
+
+        columns = slice(self.spec_bounds[spec], self.spec_bounds[spec+1])
+        nCorrect = nCorrect[:, columns]
+        n_iterations, n_plot = nCorrect.shape
+
+        bootstrap_results = self.spec_labels[spec].iloc[np.tile(np.arange(n_plot), n_iterations)].reset_index(drop=True)
+        bootstrap_results['nTrials'] = np.tile(self.plot_nTrials[columns], n_iterations)
+        bootstrap_results['nCorrect'] = nCorrect.ravel()
+        bootstrap_results['pCorrect'] = bootstrap_results['nCorrect'] / bootstrap_results['nTrials'] * 100
+        bootstrap_results['iteration'] = np.repeat(np.arange(n_iterations), n_plot) + first_iteration
+
+        return bootstrap_results
+
+
+    def summarize_bootstrap(self, bootstrap_results: pd.DataFrame, plot_columns: Optional[list] = None) -> pd.DataFrame:
         """ Get mean performance across bootstrap resamples"""
+
+        plot_columns = self.plot_columns if plot_columns is None else plot_columns
         
         # Group by all the variables we care about
-        g = bootstrap_results.drop(columns=['nTrials','nCorrect','iteration']).groupby(by=self.plot_columns)
+        g = bootstrap_results.drop(columns=['nTrials','nCorrect','iteration']).groupby(by=plot_columns)
 
         # Give each metric it's name        
         pCorrect_mean = g.mean().rename({'pCorrect':'mean'}, axis=1)
@@ -138,28 +597,487 @@ class summary_table():
 
         # Join and send the variable information back into the dataframe 
         table = pCorrect_mean.join(pCorrect_std)
-        table.reset_index(self.plot_columns, inplace=True)
+        table.reset_index(plot_columns, inplace=True)
 
         return table
 
 
     def count_correct_trials(self) -> None:
 
+        """ Count correct trials (or bootstrap them), with results for each set of plot columns in spec_data and spec_tables, 
+        of which the first is also kept as bootstrap_data and table """
+
         if self.nBootstrap == 0:
-            self.table = count_correct_trials(self.data, self.plot_columns)
+            self.spec_data = [None for _ in self.spec_columns]
+            self.spec_tables = self.count_cells()
+            self.table = self.spec_tables[0]
 
         else:
             print('Running bootstrap - this might take a while')
-            self.bootstrap_data, self.flattened_sample = self.bootstrap_resample()
-            self.table = self.summarize_bootstrap( self.bootstrap_data)
+
+            if self.is_chunked() and self.engine != 'vectorized':
+                raise ValueError('Parallel (n_jobs), streaming, checkpointed and adaptive bootstraps require the vectorized engine')
+
+            if self.streaming and self.keep_samples == 'all':
+                raise ValueError("Keeping all samples stores every iteration, so can't be combined with streaming")
+
+            if self.tolerance is not None:
+                self.nBootstrap = max(self.nBootstrap // self.chunk_size, 1) * self.chunk_size     # Adaptive runs stop between whole chunks
+
+            if self.streaming:
+                self.spec_data = [None for _ in self.spec_columns]
+                self.spec_tables, sample = self.bootstrap_stream()
+
+            elif self.engine == 'vectorized':
+                self.spec_data, sample = self.bootstrap_resample_vectorized()
+            elif self.engine == 'pandas':
+                self.spec_data, sample = self.bootstrap_resample()
+            else:
+                raise ValueError(f"Unknown bootstrap engine: {self.engine}")
+
+            # Row positions (one iteration, or iterations x trials) are kept as indices into the source data
+            self.flattened_sample = self.data.iloc[sample if sample.ndim == 1 else sample[-1]]
+            self.sample_rows = row_index(self.data, sample)
+
+            if not self.is_chunked():
+                self.n_iterations = self.nBootstrap
+
+            if not self.streaming:
+                self.spec_tables = [self.summarize_bootstrap(x, c) for x, c in zip(self.spec_data, self.spec_columns)]
+
+            self.bootstrap_data, self.table = self.spec_data[0], self.spec_tables[0]
 
 
     def post_processing(self) -> None:
         """ Add extra information for plotting - this isn't the cleanest code, sorry!"""
 
-        if any(self.table.columns == 'Treatment'):
-            self.table['Treatment'] = self.table['treatment'].replace({True:'Test', False:'Control'})                              # Labels that are consistent with other areas of the project (could be cleaner)        
+        for table in self.spec_tables:
+            if any(table.columns == 'Treatment'):
+                table['Treatment'] = table['treatment'].replace({True:'Test', False:'Control'})                              # Labels that are consistent with other areas of the project (could be cleaner)        
+
+
+
+@dataclass()
+class result_cache():
+    """ On-disk store of bootstrap results, addressed by a hash of the input data and all parameters """
+
+    cache_dir : str
+
+    def __post_init__(self):
+        self.cache_dir = Path(self.cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+
+    @staticmethod
+    def key(df: pd.DataFrame, **params) -> str:
+        """ Hash of dataframe contents (values, index, column names and types) and parameters """
+
+        digest = hashlib.sha256()
+        digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+        digest.update(json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes))]).encode())
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+        return digest.hexdigest()
+
+
+    def get(self, key: str) -> Optional[dict]:
+        """ Stored results for key (or None if not yet computed) """
+
+        file_path = self.cache_dir / f"{key}.pkl"
+
+        if file_path.exists():
+            self.hits += 1
+            print(f"\t\tLoaded bootstrap from cache ({key[:12]})")
+            return pd.read_pickle(file_path)
+
+        self.misses += 1
+        return None
+
+
+    def put(self, key: str, entry: dict) -> None:
+        """ Store results for key """
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        pd.to_pickle(entry, self.cache_dir / f"{key}.pkl")
+
+
+    def stats(self) -> dict:
+        """ Number of cache hits and misses in this session """
+
+        n_lookups = self.hits + self.misses
+
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / n_lookups if n_lookups > 0 else np.nan)
+
+
+
+@dataclass()
+class bootstrap_accumulator():
+    """ Running summary of bootstrap iterations, with memory that scales with conditions rather than iterations """
+
+    nTrials : np.ndarray            # Number of trials sampled for each plot condition on every iteration
+
+    def __post_init__(self):
+        n_conditions = self.nTrials.size
+
+        self.n = 0
+        self.mean = np.zeros(n_conditions)
+        self.m2 = np.zeros(n_conditions)
+
+        # Histogram of correct counts: pCorrect can only take nTrials+1 values, so quantiles are exact
+        self.counts = np.zeros((n_conditions, self.nTrials.max() + 1), dtype=np.int64)
+
+
+    def update(self, nCorrect: np.ndarray) -> None:
+        """ Fold a batch of iterations (iterations x conditions) into the running mean, variance and histogram """
+
+        pCorrect = nCorrect / self.nTrials * 100
+        n_batch = pCorrect.shape[0]
+
+        # Parallel form of Welford's algorithm (Chan et al., 1979) for merging batch moments
+        batch_mean = pCorrect.mean(axis=0)
+        batch_m2 = ((pCorrect - batch_mean) ** 2).sum(axis=0)
+        delta = batch_mean - self.mean
+        n_total = self.n + n_batch
+
+        self.mean = self.mean + delta * n_batch / n_total
+        self.m2 = self.m2 + batch_m2 + delta ** 2 * self.n * n_batch / n_total
+        self.n = n_total
+
+        n_bins = self.counts.shape[1]
+        bins = np.arange(self.nTrials.size) * n_bins + np.rint(nCorrect).astype(np.int64)
+        self.counts += np.bincount(bins.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+
+
+    def std(self) -> np.ndarray:
+        """ Sample standard deviation of pCorrect (as in pandas) """
+        return np.sqrt(self.m2 / (self.n - 1))
+
+
+    def quantile(self, q: float) -> np.ndarray:
+        """ Quantile of pCorrect for each condition (linear interpolation, as numpy.quantile) """
+
+        position = (self.n - 1) * q
+        lower, upper = np.floor(position), np.ceil(position)
+
+        cumulative = self.counts.cumsum(axis=1)
+        lower_count = (cumulative <= lower).sum(axis=1)              # Value of order statistic = first bin with cumulative count above its rank
+        upper_count = (cumulative <= upper).sum(axis=1)
+
+        nCorrect = lower_count + (position - lower) * (upper_count - lower_count)
+
+        return nCorrect / self.nTrials * 100
+
+
+    def monte_carlo_error(self, ci: float) -> np.ndarray:
+        """ Largest Monte Carlo standard error (in % correct) of the mean and confidence interval endpoints for each condition 
+        
+        The standard error of a quantile q is sqrt(q(1-q)/n) / f(x_q), with the density f at the 
+        endpoint approximated by a normal distribution with the running standard deviation.
+        """
+
+        q = (100 - ci) / 200
+        std = self.std()
+
+        mean_error = std / np.sqrt(self.n)
+        quantile_error = std * np.sqrt(q * (1 - q) / self.n) / norm.pdf(norm.ppf(q))
+
+        return np.maximum(mean_error, quantile_error)
+
+
+    def summarize(self, labels: pd.DataFrame, ci: float) -> pd.DataFrame:
+        """ Table of mean, std and confidence interval of pCorrect for each condition """
+
+        table = labels.copy()
+        table['mean'] = self.mean
+        table['std'] = self.std()
+        table['ci_lower'] = self.quantile((100 - ci) / 200)
+        table['ci_upper'] = self.quantile(1 - (100 - ci) / 200)
+
+        return table
+
+
+
+# FILE I/O:
+table_formats = ('parquet', 'feather', 'csv')              # Order of preference when reading
+
+
+def compact_table(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduce the memory (and file) footprint of a results table by encoding
+    text labels (e.g. Mask, Condition, vowel) as categoricals and storing
+    counts (e.g. nTrials, nCorrect, iteration) as the narrowest integer type
+    
+    Parameters:
+    ----------
+    df : pandas dataframe
+        Table of bootstrap results or sample data
+
+    >>> [str(x) for x in compact_table(pd.DataFrame(dict(Mask=['Clean','Clean'], nCorrect=[2.0, 3.0], iteration=[0, 1]))).dtypes]
+    ['category', 'uint8', 'uint8']
+
+    Returns:
+    --------
+    df : pandas dataframe
+        Copy of input with compact dtypes (boolean and floating values are unchanged)
+    """
+
+    df = df.copy()
+
+    for column in df.columns:
+        values = df[column]
+
+        if column in ('nTrials', 'nCorrect') and pd.api.types.is_float_dtype(values) and np.all(np.mod(values, 1) == 0):
+            values = values.astype(np.int64)                            # Counts summed from float Correct columns
+
+        if pd.api.types.is_bool_dtype(values):
+            continue
+        elif pd.api.types.is_integer_dtype(values):
+            df[column] = pd.to_numeric(values, downcast='unsigned' if values.min() >= 0 else 'integer')
+        elif pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+            df[column] = values.astype('category')
+
+    return df
+
+
+def write_table(df: pd.DataFrame, file_path: Path, file_format: str = 'csv') -> None:
+    """ Save table with the extension for its format (binary formats are written with compact dtypes) """
+
+    file_path = Path(file_path)
+    file_path = file_path.with_name(f"{file_path.name}.{file_format}")
+
+    if file_format == 'csv':
+        df.to_csv(file_path, index=False)
+    elif file_format == 'parquet':
+        compact_table(df).to_parquet(file_path, index=False)
+    elif file_format == 'feather':
+        compact_table(df).reset_index(drop=True).to_feather(file_path)
+    else:
+        raise ValueError(f"Unknown table format: {file_format}")
+
+
+def write_results(file_stem: Path, results: Optional[pd.DataFrame], summary: pd.DataFrame, sample_data, file_format: str = 'csv') -> None:
+    """ Save bootstrap results (or the summary if results were streamed) and sample data (a table, or an array of 
+    row indices saved as .npy), with names starting with file_stem """
+
+    if results is None:
+        write_table(summary, f"{file_stem}_SUMMARY", file_format)
+    else:
+        write_table(results, file_stem, file_format)
+
+    if isinstance(sample_data, np.ndarray):
+        np.save(f"{file_stem}_SAMPLE.npy", sample_data)
+    else:
+        write_table(sample_data, f"{file_stem}_SAMPLE", file_format)
+
+
+def row_index(df: pd.DataFrame, positions: np.ndarray) -> np.ndarray:
+    """ Index labels of rows at positions in df, as uint32 
+    
+    Data loaded with ferret.load_data is labelled by row number in the analysis file (which subsets of data keep), 
+    so indices refer to the source file. Positions are kept instead if labels aren't non-negative integers.
+    """
+
+    labels = df.index.to_numpy()
+
+    if pd.api.types.is_integer_dtype(labels) and labels.size > 0 and labels.min() >= 0 and labels.max() <= np.iinfo(np.uint32).max:
+        return labels[positions].astype(np.uint32)
+
+    return np.asarray(positions, dtype=np.uint32)
+
+
+@dataclass()
+class sample_index():
+    """ Flattened samples saved as row indices (see ferret.write_results), materialized one iteration at a time 
+    
+    e.g. sample_index('Results/Vowels_in_Noise/data/bootstrap/F1509_OVER_SNR_SAMPLE.npy', f.data)[-1] gives the 
+    flattened data for the last iteration kept
+    """
+
+    file_path : str
+    data : pd.DataFrame             # Analysis data the samples were drawn from (as loaded by ferret.load_data)
+
+    def __post_init__(self):
+        self.rows = np.load(self.file_path, mmap_mode='r')          # Only pages for iterations requested are read
+
+        if self.rows.ndim == 1:
+            self.rows = self.rows[np.newaxis, :]
+
+
+    def __len__(self) -> int:
+        return self.rows.shape[0]
+
+
+    def __getitem__(self, iteration: int) -> pd.DataFrame:
+        """ Flattened data drawn on an iteration """
+        return self.data.loc[np.asarray(self.rows[iteration])]
+
+
+def read_table(file_path: Path) -> pd.DataFrame:
+    """ Load table from file path, or from the preferred format available if file path has no extension """
+
+    file_path = Path(file_path)
+
+    if file_path.suffix[1:] not in table_formats:
+        candidates = [file_path.with_name(f"{file_path.name}.{x}") for x in table_formats]
+        file_path = next((x for x in candidates if x.exists()), candidates[-1])
+
+    if file_path.suffix == '.parquet':
+        return pd.read_parquet(file_path)
+    elif file_path.suffix == '.feather':
+        return pd.read_feather(file_path)
+    else:
+        return pd.read_csv(file_path)
+
+
+def find_tables(data_dir: Path, pattern: str) -> list:
+    """ Paths (without extensions) of tables matching a glob pattern, in any supported format """
+
+    stems = {x.with_suffix('') for x in Path(data_dir).glob(f"{pattern}.*") if x.suffix[1:] in table_formats}
+
+    return sorted(stems)
+
+
+# RESAMPLING:
+def factorize_cells(df: pd.DataFrame, columns: list) -> tuple:
+    """
+    Encode each combination of values in columns as an integer cell code,
+    numbered in the same (sorted) order as groups from DataFrame.groupby
+
+    Parameters:
+    ----------
+    df : pandas dataframe
+        Data containing key columns (e.g. Mask, treatment, SNR, vowel)
+    columns : list of str
+        Key columns that define cells
+
+    >>> codes, labels = factorize_cells(pd.DataFrame(dict(Mask=['Noise','Clean','Noise',None], SNR=[0, 6, 0, 6])), ['Mask','SNR'])
+    >>> codes
+    array([ 1,  0,  1, -1])
+    >>> labels
+        Mask  SNR
+    0  Clean    6
+    1  Noise    0
+
+    Returns:
+    --------
+    codes : numpy array
+        Cell code for each row (-1 where any key is missing, which groupby would drop)
+    labels : pandas dataframe
+        Values of key columns for each observed cell (row i describes code i)
+    """
+
+    column_codes, column_values = zip(*[pd.factorize(df[c], sort=True) for c in columns])
+    n_values = [max(len(x), 1) for x in column_values]
+
+    missing = np.any([x < 0 for x in column_codes], axis=0)
+    combined = np.ravel_multi_index([np.where(missing, 0, x) for x in column_codes], n_values)
+
+    observed, observed_codes = np.unique(combined[~missing], return_inverse=True)
+
+    codes = np.full(missing.size, -1, dtype=np.intp)
+    codes[~missing] = observed_codes
+
+    value_index = np.unravel_index(observed, n_values)
+    labels = pd.DataFrame({c: values.take(i) for c, values, i in zip(columns, column_values, value_index)})
+
+    return codes, labels
+
+
+def group_specs(df: pd.DataFrame, specs: dict) -> list:
+    """
+    Group bootstrap specifications that flatten the same cells of data, so
+    that they can be summarized from one set of resamples. Cells match when
+    their columns (plot + flat) split data identically, which includes sets
+    of columns that differ only by variables derived from others (e.g.
+    speaker hemifield from speaker position)
+
+    Parameters:
+    ----------
+    df : pandas dataframe
+        Data to be resampled
+    specs : dict
+        Names of specifications, each with a tuple of (plot_vars, flat_vars)
+
+    >>> df = pd.DataFrame(dict(Mask=['Clean','Noise']*4, SNR=[0,0,6,6]*2, vowel=list('aaaabbbb')))
+    >>> group_specs(df, dict(BY_SNR=(['Mask','SNR'], ['vowel']), OVER_SNR=(['Mask'], ['SNR','vowel']), OVER_VOWEL=(['Mask'], ['vowel'])))
+    [['BY_SNR', 'OVER_SNR'], ['OVER_VOWEL']]
+
+    Returns:
+    --------
+    groups : list of lists
+        Names of specifications in each group (in order of first appearance)
+    """
+
+    def n_cells(columns):
+        return df.groupby(by=list(columns)).ngroups
+
+    groups = []                                     # Tuples of cell columns and specification names
+
+    for name, (plot_vars, flat_vars) in specs.items():
+        cell_columns = plot_vars + flat_vars
+
+        for group_columns, names in groups:
+            n_union = n_cells(dict.fromkeys(group_columns + cell_columns))
+
+            if n_union == n_cells(group_columns) == n_cells(cell_columns):
+                names.append(name)
+                break
+        else:
+            groups.append((cell_columns, [name]))
+
+    return [names for _, names in groups]
+
+
+def resample_cells(generator, n_iterations, correct, cell_rows, cell_offsets, plot_starts, n_samples, sample_iteration=-1, cell_order=None) -> tuple:
+    """
+    Resample a fixed number of trials (with replacement) from every cell on 
+    many iterations, and count correct trials for each plot condition
+    
+    Parameters:
+    ----------
+    generator : numpy Generator
+        Random stream used to draw row positions
+    n_iterations : int
+        Number of bootstrap iterations to draw
+    correct : numpy array
+        Whether the subject was correct on each trial (one value per row)
+    cell_rows : numpy array
+        Row positions sorted by cell
+    cell_offsets : numpy array
+        Start of each cell within cell_rows (with the total number of rows appended)
+    plot_starts : numpy array
+        Index of the first cell belonging to each plot condition
+    n_samples : int
+        Number of trials to draw from each cell on each iteration
+    sample_iteration : int or slice, optional
+        Iteration(s) for which drawn row positions are returned (default: last)
+    cell_order : numpy array, optional
+        Cells (repeated for each set of plot conditions) in the order indexed by plot_starts
+
+    Returns:
+    --------
+    nCorrect : numpy array
+        Number of correct trials for each iteration (rows) and plot condition (columns)
+    sample : numpy array
+        Row positions drawn on sample_iteration, in cell order (iterations x trials for a slice)
+    """
+
+    n_cells = cell_offsets.size - 1
+    cell_nCorrect = np.zeros((n_iterations, n_cells), dtype=correct.dtype)
+    sample = []
+
+    for c in range(n_cells):
+        rows = cell_rows[cell_offsets[c]:cell_offsets[c+1]]
+        draws = rows[generator.integers(0, rows.size, size=(n_iterations, n_samples))]
+
+        cell_nCorrect[:, c] = correct[draws].sum(axis=1)
+        sample.append(draws[sample_iteration])
+
+    if cell_order is not None:
+        cell_nCorrect = cell_nCorrect[:, cell_order]
 
+    return np.add.reduceat(cell_nCorrect, plot_starts, axis=1), np.concatenate(sample, axis=-1)
 
 
 # ANALYSIS:
@@ -0,0 +1,225 @@
+"""
+Pipelines of registered processing steps for dataframes, with on-disk caching of intermediate
+results and a record of the time, rows and memory used by each step
+
+Steps are pure functions that take a dataframe (and parameters) and return a new dataframe,
+without modifying their input. Each intermediate result is addressed by a hash of the input data
+and every step up to that point (name, version, parameters and the source code of the step and the
+project code it uses), so that re-running a pipeline after changing a late step loads the last
+unchanged result and skips all upstream work.
+
+"""
+from dataclasses import dataclass, field
+import hashlib
+import inspect
+import json
+from pathlib import Path
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+from lib.bootstrap import result_cache
+
+
+registered_steps = {}
+step_versions = {}
+project_root = Path(__file__).resolve().parents[1]      # Code below this directory is part of the project (see step_source)
+
+
+def register_step(function: Optional[Callable] = None, version: int = 0) -> Callable:
+    """ Make a function available as a pipeline step (use as a decorator, or call on existing functions) 
+    
+    Cached results depend on the source of the step and of the project functions and modules it uses (see 
+    step_source). Bump version when the step changes in any other way (e.g. through a helper that is looked 
+    up at run time), so that results cached before are not reused.
+    """
+
+    if function is None:
+        return lambda x: register_step(x, version=version)          # Used as @register_step(version=...)
+
+    registered_steps[step_id(function)] = function
+    step_versions[step_id(function)] = version
+    return function
+
+
+def step_id(function: Callable) -> str:
+    """ Unique name of a step function """
+
+    return f"{function.__module__}.{function.__qualname__}"
+
+
+def step_source(function: Callable) -> str:
+    """ Source code behind a step function (so that editing the step or its helpers invalidates cached results) 
+    
+    Includes the source of the step, of project functions it calls (and those they call, in turn), and of 
+    project modules it refers to by name (e.g. Results.cooling_analysis as ca, when calling ca.round_to_nearest).
+    Functions and modules from installed packages are not included.
+    """
+
+    sources = {}
+    pending = [function]
+
+    while pending:
+        x = pending.pop()
+
+        if inspect.ismodule(x):
+            sources[x.__name__] = code_source(x)
+            continue
+
+        sources[step_id(x)] = code_source(x)
+
+        for name in referenced_names(x.__code__):
+            value = x.__globals__.get(name)
+            is_used = inspect.ismodule(value) or inspect.isfunction(value)
+
+            if is_used and is_project_code(value) and (value.__name__ if inspect.ismodule(value) else step_id(value)) not in sources:
+                pending.append(value)
+
+    return '\n'.join(sources[x] for x in sorted(sources))
+
+
+def referenced_names(code) -> set:
+    """ Global names used by compiled code, including nested functions and comprehensions """
+
+    names = set(code.co_names)
+
+    for x in code.co_consts:
+        if inspect.iscode(x):
+            names |= referenced_names(x)
+
+    return names
+
+
+def is_project_code(value) -> bool:
+    """ Whether a function or module is defined in a file within the project (rather than an installed package) """
+
+    module = value if inspect.ismodule(value) else inspect.getmodule(value)
+    file_path = getattr(module, '__file__', None)
+
+    return file_path is not None and Path(file_path).resolve().is_relative_to(project_root)
+
+
+def code_source(value) -> str:
+    """ Source code of a function or module (or its name, if the source isn't available) """
+
+    try:
+        return inspect.getsource(value)
+    except (OSError, TypeError):
+        return value.__name__
+
+
+
+@dataclass()
+class step():
+    """ A registered function and the parameters it is called with """
+
+    function : Callable
+    params : dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if step_id(self.function) not in registered_steps:
+            raise ValueError(f"{step_id(self.function)} is not a registered pipeline step")
+
+        self.name = self.function.__name__
+
+
+    def key(self, input_key: str) -> str:
+        """ Hash of the input key, this step's function, version, parameters and source code """
+
+        digest = hashlib.sha256()
+        digest.update(input_key.encode())
+        digest.update(json.dumps([step_id(self.function), step_versions[step_id(self.function)], self.params], sort_keys=True, default=str).encode())
+        digest.update(step_source(self.function).encode())
+
+        return digest.hexdigest()
+
+
+    def run(self, df: pd.DataFrame) -> pd.DataFrame:
+        """ Apply step to data """
+        return self.function(df, **self.params)
+
+
+
+@dataclass()
+class pipeline():
+    """ Sequence of steps applied to a dataframe, with results of each step optionally cached in cache_dir """
+
+    steps : list                            # Steps, or (function, params) tuples, or functions without parameters
+    cache_dir : Optional[str] = None
+    trace_memory : bool = True              # Record peak memory allocated by each step (tracemalloc slows steps down)
+
+    def __post_init__(self):
+        self.steps = [x if isinstance(x, step) else step(*x) if isinstance(x, tuple) else step(x) for x in self.steps]
+        self.cache_dir = Path(self.cache_dir) if self.cache_dir is not None else None
+
+
+    def run(self, df: pd.DataFrame) -> pd.DataFrame:
+        """ Apply all steps to data, starting from the last cached result, and record the cost of each step in log """
+
+        keys = self.step_keys(df)
+        first = self.last_cached_step(keys) + 1
+        log = [dict(step=x.name, cached=True, seconds=0.0, rows_in=np.nan, rows_out=np.nan, peak_bytes=np.nan) for x in self.steps[:first]]
+
+        if first > 0:
+            start_time = time.perf_counter()
+            df = pd.read_pickle(self.cache_dir / f"{keys[first-1]}.pkl")
+
+            log[-1].update(seconds=time.perf_counter() - start_time, rows_out=df.shape[0])
+            print(f"\t\tLoaded {first} of {len(self.steps)} steps from cache ({keys[first-1][:12]})")
+
+        for x, key in zip(self.steps[first:], keys[first:]):
+
+            rows_in = df.shape[0]
+            is_tracing = self.trace_memory and not tracemalloc.is_tracing()
+
+            if is_tracing:
+                tracemalloc.start()
+            elif self.trace_memory:
+                tracemalloc.reset_peak()
+
+            start_time = time.perf_counter()
+            df = x.run(df)
+            seconds = time.perf_counter() - start_time
+
+            peak_bytes = tracemalloc.get_traced_memory()[1] if self.trace_memory else np.nan
+
+            if is_tracing:
+                tracemalloc.stop()
+
+            if self.cache_dir is not None:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                pd.to_pickle(df, self.cache_dir / f"{key}.pkl")
+
+            log.append( dict(step=x.name, cached=False, seconds=seconds, rows_in=rows_in, rows_out=df.shape[0], peak_bytes=peak_bytes))
+
+        self.log = pd.DataFrame(log)
+
+        return df
+
+
+    def step_keys(self, df: pd.DataFrame) -> list:
+        """ Chain of keys addressing the result of each step, starting from a hash of the input data """
+
+        keys = [result_cache.key(df)]
+
+        for x in self.steps:
+            keys.append( x.key(keys[-1]))
+
+        return keys[1:]
+
+
+    def last_cached_step(self, keys: list) -> int:
+        """ Index of the last step with a cached result (-1 if none) """
+
+        if self.cache_dir is None:
+            return -1
+
+        for i in range(len(keys) - 1, -1, -1):
+            if (self.cache_dir / f"{keys[i]}.pkl").exists():
+                return i
+
+        return -1
+
@@ -2,6 +2,7 @@
 
 cooled_threshold = 20           # Temperature below which cortex is considered to be 'cooled'
 warm_threshold = 35             # Temperature above which cortex is considered to be 'warm'
+control_limit = 0.6             # Min proportion correct at each attenuation during control testing (see constrain_attenutations_by_control_performance)
 
 min_level = 50                  # Min sound level used
 min_trials = 10                 # Min number of trials for each attenuation (across masks)